@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .types import AlbumsResponse, CreateAlbumResponse
+
+logger = logging.getLogger(__name__)
+
+
+class AlbumIndex:
+    """
+    Maps album names to ids so an album is found without paging through every album of the account.
+
+    The API lists albums newest first so a refresh stops at the first page without any album it didn't know about.
+    With a `path` the index is kept in SQLite between runs, per `account`. Missing albums are created up to
+    `max_creates` at a time and an album that is asked for while it is being created is only created once.
+    """
+
+    # Albums the API returns per page
+    page_size = 50
+
+    def __init__(
+        self,
+        list_albums: Callable[[int], Awaitable[AlbumsResponse]],
+        create_album: Callable[[str], Awaitable[CreateAlbumResponse]],
+        path: Optional[Path] = None,
+        account: str = "",
+        max_creates: int = 4,
+    ):
+        self.list_albums = list_albums
+        self.create_album = create_album
+        self.account = account
+        self.albums: Dict[str, str] = {}
+        self._refreshed = False
+        self._refresh_lock = asyncio.Lock()
+        self._creating: Dict[str, asyncio.Future] = {}
+        self._create_semaphore = asyncio.Semaphore(max_creates)
+
+        self.db = None
+        if path:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(str(path), isolation_level=None, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS albums (
+                    account TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY (account, id)
+                )"""
+            )
+            # Newer albums win when several have the same name, like they do in the listing
+            for album_id, name in self.db.execute(
+                "SELECT id, name FROM albums WHERE account = ? ORDER BY CAST(id AS INTEGER)", (account,)
+            ):
+                self.albums[name] = album_id
+
+    def add(self, name: str, album_id: str) -> None:
+        self.albums[name] = album_id
+        if self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO albums (account, id, name) VALUES (?, ?, ?)", (self.account, album_id, name)
+            )
+
+    async def refresh(self, full: bool = False) -> None:
+        """Looks for albums that aren't known yet, or reloads every album with `full` to forget deleted ones"""
+        async with self._refresh_lock:
+            if full:
+                self.albums.clear()
+                if self.db:
+                    self.db.execute("DELETE FROM albums WHERE account = ?", (self.account,))
+            known = set(self.albums.values())
+            found = {}
+            page = 1
+            while True:
+                response = await self.list_albums(page)
+                albums = response.get("albums") or []
+                new = [x for x in albums if str(x["id"]) not in known]
+                for album in new:
+                    # Pages go from newest to oldest so the first album with a name is the newest one
+                    found.setdefault(album["name"], str(album["id"]))
+                if len(albums) < self.page_size or not new:
+                    break
+                page += 1
+            for name, album_id in found.items():
+                self.add(name, album_id)
+            logger.debug(f"Found {len(found)} new albums in {page} pages, {len(self.albums)} albums are known")
+            self._refreshed = True
+
+    async def get_id(self, name: str, create: bool = True) -> Optional[str]:
+        """Returns the id of the album with this name, creating the album when it doesn't exist yet"""
+        if name in self.albums:
+            return self.albums[name]
+        if not self._refreshed:
+            await self.refresh()
+            if name in self.albums:
+                return self.albums[name]
+        if not create:
+            return None
+        if name not in self._creating:
+            self._creating[name] = asyncio.ensure_future(self._create(name))
+        return await self._creating[name]
+
+    async def _create(self, name: str) -> Optional[str]:
+        async with self._create_semaphore:
+            logger.info(f"Creating album {name}")
+            response = await self.create_album(name)
+        if not response.get("success"):
+            logger.error(f"Unable to create album {name}: {response}")
+            return None
+        # create_album already added it to the index
+        return str(response["id"])
+
+    async def get_ids(self, names: List[str]) -> Dict[str, Optional[str]]:
+        """Looks up several albums at once, the missing ones are created concurrently"""
+        if not self._refreshed:
+            await self.refresh()
+        ids = await asyncio.gather(*[self.get_id(x) for x in names])
+        return dict(zip(names, ids))
+
+    def close(self) -> None:
+        if self.db:
+            self.db.close()
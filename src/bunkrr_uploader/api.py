@@ -1,30 +1,111 @@
 import asyncio
+import functools
 import hashlib
 import logging
 import mimetypes
 import os
+import time
+import urllib.parse
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pprint import pformat, pprint
-from typing import Any, BinaryIO, Optional, Union
+from typing import (
+    Any,
+    AsyncIterable,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import aiohttp
-from tqdm.asyncio import tqdm_asyncio
 
+from .albums import AlbumIndex
+from .chunking import ChunkSizePolicy
+from .concurrency import AdaptiveLimiter
+from .connection import ConnectionPool
+from .hashindex import HashIndex, StreamHasher, md5_file
+from .hedging import ChunkDeadlines
+from .journal import UploadJournal
+from .nodes import NodePool
+from .payload import BLOCK_SIZE, FileRangePayload
+from .progress import ProgressReporter
+from .reader import BufferPool
+from .retry import (
+    PERMANENT,
+    REJECTED,
+    TRANSIENT,
+    RetryBudget,
+    RetryPolicy,
+    UploadError,
+    classify,
+    response_json,
+)
+from .scheduler import UploadScheduler
+from .shaping import BandwidthShaper
+from .split import FilePart, UploadSource, source_range, source_size
+from .state import StateCache, parse_limits
+from .telemetry import Telemetry
 from .types import (
     AlbumsResponse,
     CheckResponse,
     CreateAlbumResponse,
+    File,
     NodeResponse,
+    ServerLimits,
     UploadResponse,
     VerifyTokenResponse,
 )
-from .util import ProgressFileReader, TqdmUpTo
+from .util import get_config_dir
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 
+DEFAULT_API_URL = "https://app.bunkrr.su"
+
+
+def add_metadata(response: UploadResponse, metadata: UploadResponse) -> UploadResponse:
+    """Adds what we know about the local file to what the server returned for it"""
+    files = response.get("files") or [{}]
+    files[0] = {**metadata["files"][0], **files[0]}
+    response["files"] = files
+    return response
+
+
+def upload_result(response: UploadResponse) -> str:
+    if response.get("success"):
+        files = response.get("files") or [{}]
+        return "duplicate" if files[0].get("uploadSuccess") == "duplicate" else "uploaded"
+    return "failed"
+
+
+def worker_path(path: Optional[Path], worker: Optional[int]) -> Optional[Path]:
+    """Worker processes write to `name-worker-N.ext` next to the file that was asked for"""
+    if path is None or worker is None:
+        return path
+    path = Path(path)
+    return path.with_name(f"{path.stem}-worker-{worker}{path.suffix}")
+
+
+def match_files(files: List[UploadSource], returned: List[File]) -> List[Optional[File]]:
+    """Pairs the entries the server returned for a multi-file upload with the files sent, by name or else by order"""
+    if any("original" in x for x in returned):
+        by_name: Dict[str, List[File]] = {}
+        for entry in returned:
+            by_name.setdefault(entry["original"], []).append(entry)
+        return [by_name[x.name].pop(0) if by_name.get(x.name) else None for x in files]
+    if len(returned) == len(files):
+        return list(returned)
+    return [None] * len(files)
+
+
 class BunkrrAPI:
     def __init__(
         self,
@@ -37,28 +118,226 @@ class BunkrrAPI:
             options = {}
 
         self.token = token
-        self.url = "https://app.bunkrr.su/"
+        # Another server with the same API can be used instead, such as the bundled mock server
+        self.url = (options.get("api_url") or DEFAULT_API_URL).rstrip("/")
         self.download_url_base = "https://bunkrr.ru/d/"
 
         # These all need to be initialized later on before the API is used
         self.max_file_size = None
         self.chunk_size = None
+        self.chunk_policy: Optional[ChunkSizePolicy] = None
         self.file_blacklist = []
 
         self.options = options
+        # Journal, digests, albums and cached limits of other servers are kept apart from those of Bunkrr
+        self.config_dir = get_config_dir()
+        if self.url != DEFAULT_API_URL:
+            self.config_dir = self.config_dir / "servers" / urllib.parse.urlsplit(self.url).netloc.replace(":", "_")
 
         self.session_headers = {
             "Accept": "application/json",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
             "token": self.token,
         }
-        self.session = aiohttp.ClientSession("https://app.bunkrr.su", headers=self.session_headers)
+        # Worker processes of --processes label what they export and write files of their own
+        worker = options.get("worker")
+        self.telemetry = Telemetry(
+            worker_path(options.get("trace"), worker),
+            worker_path(options.get("metrics_file"), worker),
+            options.get("metrics_port") if worker is None else None,
+            labels={"worker": str(worker)} if worker is not None else None,
+        )
+        # Upload bandwidth in total and per node, split evenly between the worker processes of --processes
+        node_rates = dict(options.get("node_bandwidth") or [])
+        self.shaper = BandwidthShaper(
+            options.get("max_bandwidth"),
+            node_rates.pop(None, None),
+            node_rates,
+            options.get("bandwidth_schedule"),
+            path=Path(options["bandwidth_file"]) if options.get("bandwidth_file") else None,
+            share=1 / (options.get("processes") or 1) if worker is not None else 1.0,
+        )
+        # Every session shares the same connections so handshakes are only paid once per host
+        self.pool = ConnectionPool(
+            limit=options.get("pool_limit") or 100,
+            limit_per_host=options.get("pool_limit_per_host") or 0,
+            dns_cache_ttl=options.get("dns_cache_ttl") or 300,
+            keepalive_timeout=options.get("keepalive_timeout") or 60,
+            headers=self.session_headers,
+            trace_configs=[self.telemetry.trace_config()] if self.telemetry.enabled else None,
+        )
+        self.session = self.pool.session(self.url)
 
         self.server_sessions = {}
+        self.nodes = NodePool(self.get_node, ttl=options.get("node_ttl") or 600)
         self.created_folders = {}
-        self.sem = asyncio.Semaphore(max_connections)
+        account = hashlib.md5(str(token).encode("utf-8")).hexdigest()
+        # Album names mapped to ids, kept between runs per account
+        self.albums = AlbumIndex(
+            self.get_albums,
+            lambda name: self.create_album(name, name),
+            self.config_dir / "albums.sqlite3" if options.get("use_config") else None,
+            account=account,
+        )
+        # Server limits and token status from earlier runs so a run can start uploading right away
+        self.state = StateCache(
+            self.config_dir / "state.json" if options.get("use_config") else None, ttl=options.get("state_ttl") or 3600
+        )
+        self.token_key = f"token:{account}"
+        self.refreshes: Dict[str, asyncio.Future] = {}
+        self.refreshed_after_rejection = False
         self.retries = retries
-        self.max_chunk_retries = options.get("chunk_retries") or 1
+        self.max_chunk_retries = options.get("chunk_retries") or 3
+        self.finish_retries = options.get("finish_retries") or 3
+        # Failed requests are retried after a backoff and only while the node isn't failing most of them
+        self.retry_policy = RetryPolicy(base=options.get("retry_backoff") or 0.5)
+        self.retry_budget = RetryBudget()
+        # Slow chunks get a duplicate sent after this percentile of recent chunk times, or never with 0
+        self.chunk_deadlines = ChunkDeadlines(
+            percentile=options.get("hedge_percentile", 95), max_hedges=options.get("max_hedges", 2)
+        )
+        # How many chunks of a single file can be uploading at the same time
+        self.chunk_window = options.get("chunk_connections") or 1
+
+        # How many files and chunks are uploaded at once adapts to the link with -c as the ceiling
+        adaptive = not options.get("fixed_concurrency")
+        self.file_limiter = AdaptiveLimiter(max_connections, "file", initial=min(2, max_connections), adaptive=adaptive)
+        self.chunk_limiter = AdaptiveLimiter(
+            max_connections * self.chunk_window, "chunk", initial=min(4, max_connections), adaptive=adaptive
+        )
+
+        # Disk reads happen on these threads so a slow disk never blocks the event loop
+        self.read_executor = ThreadPoolExecutor(
+            max_workers=options.get("io_threads") or 4, thread_name_prefix="bunkrr-read"
+        )
+        self.read_ahead = options.get("read_ahead") or 2
+        # Acknowledged chunks are remembered on disk so unfinished uploads can be resumed
+        self.journal = UploadJournal(self.config_dir / "journal.sqlite3") if options.get("use_config") else None
+        # Digests of local files and of what was already uploaded so duplicates can be skipped
+        self.hash_index = HashIndex(self.config_dir / "hashes.sqlite3") if options.get("use_config") else None
+        self.extra_hashes = options.get("extra_hashes") or []
+        self.hash_executor = ThreadPoolExecutor(
+            max_workers=options.get("hash_threads") or 2, thread_name_prefix="bunkrr-hash"
+        )
+        self.buffer_pool = BufferPool(BLOCK_SIZE, max_idle=max_connections * self.chunk_window * (self.read_ahead + 1))
+        # Worker processes leave showing progress to the coordinator
+        self.progress = ProgressReporter(
+            options.get("progress") or "auto", options.get("progress_interval"), options.get("progress_files") or 5
+        )
+        # Order in which waiting files are uploaded and how many workers only upload small files
+        self.order = options.get("order") or "fifo"
+        self.priorities = options.get("priorities") or []
+        self.lookahead = options.get("lookahead") or 1000
+        self.small_file_workers = options.get("small_file_workers")
+        if self.small_file_workers is None:
+            self.small_file_workers = 2
+        # Small files are sent together in requests of at most this many files and bytes, the bytes default to the chunk size
+        self.batch_files = options.get("batch_files") or 10
+        self.batch_bytes = options.get("batch_bytes")
+        # Files waiting to be uploaded of every upload_files call that is running
+        self.schedulers: Set[UploadScheduler] = set()
+        self.add_gauges()
+
+    def add_gauges(self) -> None:
+        telemetry = self.telemetry
+        telemetry.gauge("queue_depth", lambda: sum(len(x) for x in self.schedulers), "Files waiting to be uploaded")
+        telemetry.gauge("connections_active", lambda: self.pool.stats()["active"], "Connections sending a request")
+        telemetry.gauge("connections_idle", lambda: self.pool.stats()["idle"], "Connections kept alive for reuse")
+        telemetry.gauge("file_uploads_active", lambda: self.file_limiter.active, "Files being uploaded")
+        telemetry.gauge("file_uploads_limit", lambda: int(self.file_limiter.limit), "Files allowed to upload at once")
+        telemetry.gauge("chunk_uploads_active", lambda: self.chunk_limiter.active, "Chunks being uploaded")
+        telemetry.gauge(
+            "chunk_uploads_limit", lambda: int(self.chunk_limiter.limit), "Chunks allowed to upload at once"
+        )
+        telemetry.gauge(
+            "bandwidth_limit_bytes", lambda: self.shaper.total.rate or 0, "Bytes per second uploads are limited to"
+        )
+        telemetry.gauge("nodes_healthy", lambda: len(self.nodes.healthy_nodes()), "Upload nodes that aren't failing")
+
+    def refresh_in_background(self, name: str, refresh: Callable[[], Awaitable[None]]) -> None:
+        if name in self.refreshes and not self.refreshes[name].done():
+            return
+
+        async def run() -> None:
+            try:
+                await refresh()
+            except Exception:
+                logger.exception(f"Unable to refresh the {name}")
+
+        self.refreshes[name] = asyncio.ensure_future(run())
+
+    async def load_limits(self) -> None:
+        """Uses the cached server limits, only waiting for the server on the first run, and refreshes stale ones"""
+        limits, fresh = self.state.get("limits")
+        if limits is None:
+            await self.refresh_limits()
+            return
+        self.apply_limits(limits)
+        if not fresh:
+            self.refresh_in_background("server limits", self.refresh_limits)
+
+    async def refresh_limits(self) -> None:
+        check = await self.get_check()
+        logger.debug(pformat(check))
+        limits = parse_limits(check)
+        self.state.set("check", check)
+        self.state.set("limits", limits)
+        self.apply_limits(limits)
+
+    def apply_limits(self, limits: ServerLimits) -> None:
+        self.max_file_size = limits["maxFileSize"]
+        self.chunk_size = limits["chunkSize"]
+        self.file_blacklist = list(limits["blacklistExtensions"])
+
+        # The server drops unfinished chunks after this many milliseconds
+        chunk_timeout = limits["chunkTimeout"]
+        if self.journal and chunk_timeout:
+            self.journal.max_age = chunk_timeout / 1000
+        # A single chunk can't take longer than the server keeps the upload around
+        if chunk_timeout:
+            self.chunk_deadlines.set_max_deadline(chunk_timeout / 1000)
+
+        # Each node gets its own chunk size between the default and the max depending on how fast it is, what was
+        # learned about the nodes is kept unless the limits changed
+        policy = self.chunk_policy
+        if policy is None or (policy.min_size, policy.max_size) != (limits["chunkSize"], limits["maxChunkSize"]):
+            self.chunk_policy = ChunkSizePolicy(
+                limits["chunkSize"],
+                limits["maxChunkSize"],
+                timeout=chunk_timeout / 1000 if chunk_timeout else None,
+                start_with_max=self.options.get("max_chunk_size", False),
+            )
+
+    def check_token(self) -> None:
+        """Warns about a token the server rejected before and checks it again in the background once that is stale"""
+        if not self.token:
+            return
+        status, fresh = self.state.get(self.token_key)
+        if status is not None and not status.get("success"):
+            logger.error(f"The token was rejected by the server: {status.get('description')}")
+        if not fresh:
+            self.refresh_in_background("token status", self.refresh_token)
+
+    async def refresh_token(self) -> None:
+        response = await self.verify_token()
+        self.state.set(self.token_key, response)
+        if not response.get("success"):
+            logger.error(f"The token was rejected by the server: {response.get('description')}")
+
+    def rejected(self, response: dict) -> None:
+        """
+        The server refused a request with a reason, such as a file that is too big or a token that is no longer
+        valid, so what we cached about it may be out of date. This refreshes it once per run.
+        """
+        if not response.get("description") or self.refreshed_after_rejection:
+            return
+        self.refreshed_after_rejection = True
+        logger.info(f"Refreshing the server limits and token status after the server said {response['description']}")
+        self.state.expire("limits")
+        self.refresh_in_background("server limits", self.refresh_limits)
+        if self.token:
+            self.state.expire(self.token_key)
+            self.refresh_in_background("token status", self.refresh_token)
 
     async def get_check(self) -> CheckResponse:
         async with self.session.get("/api/check") as resp:
@@ -66,9 +345,11 @@ class BunkrrAPI:
             return response
 
     async def get_node(self) -> NodeResponse:
-        async with self.session.get("/api/node") as resp:
-            response = await resp.json()
-            return response
+        with self.telemetry.span("node_lookup") as span:
+            async with self.session.get("/api/node") as resp:
+                response = await resp.json()
+                span["result"] = "ok" if response.get("success") else "refused"
+                return response
 
     async def verify_token(self) -> VerifyTokenResponse:
         data = {"token": self.token}
@@ -76,8 +357,8 @@ class BunkrrAPI:
             response = await resp.json()
             return response
 
-    async def get_albums(self) -> AlbumsResponse:
-        async with self.session.get("/api/albums") as resp:
+    async def get_albums(self, page: int = 1) -> AlbumsResponse:
+        async with self.session.get(f"/api/albums?page={page}") as resp:
             response = await resp.json()
             return response
 
@@ -87,39 +368,64 @@ class BunkrrAPI:
         data = {"name": name, "description": description, "public": public, "download": download}
         async with self.session.post("/api/albums", json=data) as resp:
             response = await resp.json()
+            if response.get("success"):
+                self.albums.add(name, str(response["id"]))
             return response
 
-    async def upload_chunks(
+    def file_payload(
         self,
-        file_data: Union[BinaryIO, ProgressFileReader],
+        file: UploadSource,
+        offset: int,
+        length: int,
+        file_name: str,
+        content_type: str,
+        server: str,
+        hasher: Optional[StreamHasher] = None,
+    ) -> FileRangePayload:
+        path, start = source_range(file)
+        return FileRangePayload(
+            path,
+            start + offset,
+            length,
+            pool=self.buffer_pool,
+            executor=self.read_executor,
+            read_ahead=self.read_ahead,
+            hasher=hasher,
+            throttle=self.shaper.throttle(server),
+            filename=file_name,
+            content_type=content_type,
+        )
+
+    async def upload_chunk(
+        self,
+        file: UploadSource,
         file_name: str,
         file_uuid: str,
         file_size: int,
+        chunk_size: int,
+        chunk_index: int,
+        total_chunks: int,
         session,
         server: str,
-    ) -> None:
-        total_chunks = (file_size + self.chunk_size - 1) // self.chunk_size
-        chunk_index = 0
-        dzchunkbyteoffset = 0
-
-        # Iterates all chunks
-        while chunk_index < total_chunks:
-            # logger.debug(f"Processing chunk {chunk_index + 1}/{total_chunks} for {file_name}")
-
-            chunk_data = file_data.read(self.chunk_size)
-            chunk_upload_success = False
-            chunk_upload_attempt = 0
-            if not chunk_data:
-                print("No more chunks to upload")
-                break  # Exit the loop if we've reached the end of the file
+        hasher: Optional[StreamHasher] = None,
+    ) -> int:
+        dzchunkbyteoffset = chunk_index * chunk_size
+        chunk_length = min(chunk_size, file_size - dzchunkbyteoffset)
+        # The chunk is streamed from disk as it is sent instead of being read into memory first
+        chunk_data = self.file_payload(
+            file, dzchunkbyteoffset, chunk_length, file_name, "application/octet-stream", server, hasher
+        )
+        chunk_data.prefetch()
 
+        def chunk_form() -> aiohttp.FormData:
             # likely using https://gitlab.com/meno/dropzone/-/wikis/faq#chunked-uploads
             # https://github.com/Dodotree/DropzonePHPchunks/issues/3
+            # FormData can only be sent once so it has to be rebuilt for every attempt
             data = aiohttp.FormData()
             data.add_field("dzuuid", file_uuid)
             data.add_field("dzchunkindex", str(chunk_index))
             data.add_field("dztotalfilesize", str(file_size))
-            data.add_field("dzchunksize", str(self.chunk_size))
+            data.add_field("dzchunksize", str(chunk_size))
             data.add_field("dztotalchunkcount", str(total_chunks))
             data.add_field("dzchunkbyteoffset", str(dzchunkbyteoffset))
             data.add_field(
@@ -128,137 +434,698 @@ class BunkrrAPI:
                 filename=file_name,
                 content_type="application/octet-stream",
             )
+            return data
 
-            # Retries chunks if they ever fail
-            while chunk_upload_attempt < self.max_chunk_retries and chunk_upload_success is False:
+        label = f"chunk #{chunk_index}/{total_chunks} of {file_uuid} to {server}"
+        try:
+            attempt = 0
+            while True:
                 try:
-                    async with session.post("/api/upload", data=data) as resp:
-                        response = await resp.json()
-                        if response.get("success"):
-                            chunk_index += 1
-                            dzchunkbyteoffset += self.chunk_size
-                            chunk_upload_success = True
-                        else:
-                            msg = f"{file_uuid} failed uploading chunk #{chunk_index}/{total_chunks} to {server} [{chunk_upload_attempt}/{self.max_chunk_retries}]"
-                            logger.error(msg)
-                            raise Exception(msg)
-                except Exception:
-                    chunk_upload_attempt += 1
+                    async with self.chunk_limiter:
+                        await self.send_chunk_hedged(chunk_form, chunk_length, session, server, label)
+                    return chunk_length
+                except UploadError as e:
+                    attempt += 1
+                    logger.error(f"{e} [{attempt}/{self.max_chunk_retries}]")
+                    if e.response:
+                        self.rejected(e.response)
+                    if e.kind == PERMANENT or attempt >= self.max_chunk_retries:
+                        raise
+                    if not self.retry_budget.try_retry(server):
+                        logger.warning(f"Not retrying {label} since too many requests to {server} are failing")
+                        raise
+                    self.telemetry.inc("chunk_retries_total", node=server, kind=e.kind)
+                    error = e
+                # Backing off happens without holding a chunk slot so other uploads keep using it
+                await self.retry_policy.wait(attempt - 1, error)
+        finally:
+            # Drops any blocks that were read ahead for an attempt that never got to send them
+            await chunk_data.close()
+            self.telemetry.observe("disk_wait_seconds", chunk_data.read_wait)
+
+    async def post_chunk(
+        self,
+        chunk_form: Callable[[], aiohttp.FormData],
+        chunk_length: int,
+        session,
+        server: str,
+        label: str,
+    ) -> None:
+        """Sends one copy of a chunk within its deadline, raising an UploadError unless the server acknowledged it"""
+        deadline = self.chunk_deadlines.deadline(server, chunk_length)
+        started = self.nodes.start(server)
+        uploaded = False
+        cancelled = False
+        try:
+            with self.telemetry.span("chunk", node=server, bytes=chunk_length, chunk=label) as span:
+                async with session.post(
+                    "/api/upload", data=chunk_form(), timeout=aiohttp.ClientTimeout(total=deadline)
+                ) as resp:
+                    await response_json(resp, f"Uploading {label}")
+                span["result"] = "ok"
+            uploaded = True
+            seconds = time.monotonic() - started
+            self.chunk_deadlines.record(server, chunk_length, seconds)
+            if self.chunk_policy:
+                self.chunk_policy.record(server, chunk_length, seconds, True)
+        except asyncio.TimeoutError as e:
+            raise UploadError(f"Gave up on {label} after its {deadline:.0f}s deadline") from e
+        except aiohttp.ClientError as e:
+            raise UploadError(f"Error uploading {label}: {e!r}", classify(e)) from e
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            if cancelled:
+                self.nodes.cancel(server)
+            else:
+                self.finish_request(server, started, uploaded, chunk_length, "chunk")
+                if not uploaded and self.chunk_policy:
+                    self.chunk_policy.record(server, chunk_length, time.monotonic() - started, False)
 
-            if chunk_upload_success is False:
-                msg = f"Failed uploading chunks for {file_uuid} too many times times to {server}, cannot continue"
-                logger.error(msg)
-                raise Exception(msg)
+    async def send_chunk_hedged(
+        self,
+        chunk_form: Callable[[], aiohttp.FormData],
+        chunk_length: int,
+        session,
+        server: str,
+        label: str,
+    ) -> None:
+        """
+        Sends a chunk and, once it is slower than most chunks sent to the node, a copy of it over another connection.
+        The first acknowledgement wins and the other copy is dropped. The copy goes to the same node since that is
+        where the other chunks of the file are kept until finishchunks. Raises the last failure if neither got through.
+        """
+        hedge_after = self.chunk_deadlines.hedge_after(server, chunk_length)
+        attempts = {asyncio.ensure_future(self.post_chunk(chunk_form, chunk_length, session, server, label))}
+        hedged = False
+        error: Optional[BaseException] = None
+        try:
+            while attempts:
+                done, attempts = await asyncio.wait(
+                    attempts,
+                    timeout=None if hedged or hedge_after is None else hedge_after,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for attempt in done:
+                    if attempt.exception() is None:
+                        return
+                    error = attempt.exception()
+                if done or hedged or hedge_after is None:
+                    # The first copy failed on its own or both copies were sent already
+                    continue
+                if not self.chunk_deadlines.start_hedge():
+                    hedge_after = None
+                    continue
+                hedged = True
+                logger.info(f"Hedging {label} after {hedge_after:.1f}s")
+                self.telemetry.inc("hedges_total", node=server)
+                attempts.add(
+                    asyncio.ensure_future(self.post_chunk(chunk_form, chunk_length, session, server, f"hedged {label}"))
+                )
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+            if hedged:
+                self.chunk_deadlines.finish_hedge()
 
-    # TODO: This should probably move out of API
-    async def upload(self, file: Path, album_id: Optional[str] = None) -> UploadResponse:
-        metadata = {
+    async def upload_chunks(
+        self,
+        file: UploadSource,
+        file_name: str,
+        file_uuid: str,
+        file_size: int,
+        chunk_size: int,
+        session,
+        server: str,
+        progress_callback: Optional[Callable[[int], Any]] = None,
+        acked_chunks: Optional[Set[int]] = None,
+        hasher: Optional[StreamHasher] = None,
+    ) -> None:
+        total_chunks = (file_size + chunk_size - 1) // chunk_size
+        if acked_chunks is None:
+            acked_chunks = set()
+        # Keeps up to chunk_window chunks of this file in flight, the server orders them using dzchunkindex
+        window = asyncio.Semaphore(self.chunk_window)
+        pending = set()
+
+        async def send_chunk(chunk_index: int) -> None:
+            try:
+                sent = await self.upload_chunk(
+                    file,
+                    file_name,
+                    file_uuid,
+                    file_size,
+                    chunk_size,
+                    chunk_index,
+                    total_chunks,
+                    session,
+                    server,
+                    hasher,
+                )
+                acked_chunks.add(chunk_index)
+                if self.journal:
+                    self.journal.ack(file_uuid, chunk_index)
+                if progress_callback:
+                    progress_callback(sent)
+            finally:
+                window.release()
+
+        try:
+            for chunk_index in range(total_chunks):
+                # Chunks acknowledged by an earlier attempt are never sent again
+                if chunk_index in acked_chunks:
+                    continue
+                await window.acquire()
+                # Stop scheduling new chunks as soon as one of them has failed for good
+                done = {x for x in pending if x.done()}
+                pending -= done
+                for task in done:
+                    task.result()
+                pending.add(asyncio.ensure_future(send_chunk(chunk_index)))
+            # finishchunks must only be called once every chunk has been acknowledged
+            await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def finish_request(self, server: str, started: float, success: bool, size: int, kind: str) -> None:
+        """Reports how an upload request went to everything that adapts to it"""
+        seconds = time.monotonic() - started
+        self.nodes.finish(server, started, success, size)
+        if success:
+            self.retry_budget.success(server)
+        # Chunks only tell how many chunks can be sent at once and whole files how many files
+        limiter = self.chunk_limiter if kind == "chunk" else self.file_limiter
+        limiter.record(success, size, seconds, kind)
+
+    def upload_timeout(self, session: aiohttp.ClientSession, server: str, size: int) -> aiohttp.ClientTimeout:
+        """
+        Throttled requests get as long as sending `size` bytes at the limited rate takes on top of the usual timeout,
+        otherwise a low limit makes a big upload time out on every attempt
+        """
+        rate = self.shaper.rate(server)
+        if not rate or session.timeout.total is None:
+            return session.timeout
+        # Requests running at the same time each get a share of the rate
+        sharing = max(sum(x.active for x in self.nodes.nodes.values()), self.file_limiter.max_limit, 1)
+        return aiohttp.ClientTimeout(
+            total=session.timeout.total + size * sharing / rate, sock_connect=session.timeout.sock_connect
+        )
+
+    def server_session(self, server: str) -> aiohttp.ClientSession:
+        if server not in self.server_sessions:
+            logger.info(f"Using new server connection to {server}")
+            self.server_sessions[server] = self.pool.session(server)
+        return self.server_sessions[server]
+
+    def start_chunks(
+        self, file: UploadSource, server: str, previous_uuid: Optional[str] = None
+    ) -> Tuple[str, Set[int], int]:
+        """Returns the dzuuid and chunk size to upload the file with and the chunks that were already acknowledged"""
+        chunk_size = self.chunk_policy.size_for(server) if self.chunk_policy else self.chunk_size
+        if self.journal:
+            if previous_uuid:
+                self.journal.finish(previous_uuid)
+            return self.journal.start(file, server, chunk_size)
+        return str(uuid.uuid4()), set(), chunk_size
+
+    async def file_digest(self, file: UploadSource) -> str:
+        # Only whole files have their digest cached
+        cacheable = not isinstance(file, FilePart)
+        digest = self.hash_index.cached_digest(file) if cacheable else None
+        if digest is None:
+            loop = asyncio.get_running_loop()
+            path, offset = source_range(file)
+            digest = await loop.run_in_executor(self.hash_executor, md5_file, path, offset, source_size(file))
+            if cacheable:
+                self.hash_index.store_digest(file, digest)
+        return digest
+
+    async def find_duplicate(
+        self, file: UploadSource, file_size: int, album_id: Optional[str] = None
+    ) -> Tuple[Optional[UploadResponse], Optional[str]]:
+        """Returns the earlier upload of the file to the album if there is one, and its digest if that is known"""
+        digest = self.hash_index.cached_digest(file) if self.hash_index and not isinstance(file, FilePart) else None
+
+        # Only files with the same size as something already in the album need their digest before uploading
+        if self.hash_index and self.hash_index.has_size(album_id, file_size):
+            if digest is None:
+                digest = await self.file_digest(file)
+            existing = self.hash_index.find_upload(digest, album_id)
+            if existing:
+                logger.info(f"Skipping {file.name} because it was already uploaded as {existing['url']}")
+                return {
+                    "success": True,
+                    "files": [
+                        {
+                            "name": existing["fileName"],
+                            "url": existing["url"],
+                            "fileName": file.name,
+                            "albumid": album_id,
+                            "filePath": str(file),
+                            "fileSize": file_size,
+                            "fileMD5": digest,
+                            "uploadSuccess": "duplicate",
+                        }
+                    ],
+                }, digest
+        return None, digest
+
+    def new_hasher(self, file: UploadSource, file_size: int, digest: Optional[str]) -> Optional[StreamHasher]:
+        # Files are hashed from the blocks that are read to upload them unless the digests are already known
+        if digest is not None and not self.extra_hashes:
+            return None
+        path, offset = source_range(file)
+        return StreamHasher(path, file_size, self.extra_hashes, offset)
+
+    async def upload(
+        self, file: UploadSource, album_id: Optional[str] = None, slot: Optional[AdaptiveLimiter] = None
+    ) -> UploadResponse:
+        file_size = source_size(file)
+        with self.telemetry.span("file", bytes=file_size, file=str(file)) as span:
+            duplicate, digest = await self.find_duplicate(file, file_size, album_id)
+            response = duplicate or await self.upload_new(file, file_size, album_id, digest, slot)
+            span["result"] = upload_result(response)
+            return response
+
+    async def upload_new(
+        self,
+        file: UploadSource,
+        file_size: int,
+        album_id: Optional[str] = None,
+        digest: Optional[str] = None,
+        slot: Optional[AdaptiveLimiter] = None,
+    ) -> UploadResponse:
+        hasher = self.new_hasher(file, file_size, digest)
+        self.progress.begin(file, file.name, file_size)
+        response = await self.send_file(file, album_id, hasher, slot)
+        return await self.check_upload(file, file_size, album_id, response, digest, hasher)
+
+    async def check_upload(
+        self,
+        file: UploadSource,
+        file_size: int,
+        album_id: Optional[str],
+        response: UploadResponse,
+        digest: Optional[str],
+        hasher: Optional[StreamHasher],
+    ) -> UploadResponse:
+        """Compares what the server received with the local file and remembers the upload"""
+        if not response.get("success"):
+            return response
+
+        digests = {"md5": digest}
+        if hasher:
+            loop = asyncio.get_running_loop()
+            digests = await loop.run_in_executor(self.hash_executor, hasher.hexdigests)
+            if hasher.reread:
+                self.telemetry.inc("hash_reread_bytes_total", hasher.reread)
+
+        uploaded = response["files"][0]
+        uploaded["fileMD5"] = digests["md5"]
+        for name in self.extra_hashes:
+            uploaded[f"file{name.upper()}"] = digests[name]
+
+        server_md5 = uploaded.get("md5")
+        if server_md5 and server_md5 != digests["md5"]:
+            logger.error(
+                f"{file.name} was corrupted during upload, the server has MD5 {server_md5} instead of {digests['md5']}"
+            )
+            uploaded["uploadSuccess"] = False
+            response["success"] = False
+            return response
+
+        uploaded["uploadSuccess"] = True
+        if self.hash_index:
+            if digest is None and not isinstance(file, FilePart):
+                self.hash_index.store_digest(file, digests["md5"])
+            self.hash_index.record_upload(digests["md5"], album_id, file_size, file.name, uploaded.get("url"))
+        return response
+
+    async def upload_batch(
+        self,
+        files: List[Tuple[UploadSource, int]],
+        album_id: Optional[str] = None,
+        slot: Optional[AdaptiveLimiter] = None,
+    ) -> List[UploadResponse]:
+        """
+        Uploads several small files in a single request. Files the server didn't take or that arrived corrupted are
+        uploaded again on their own.
+        """
+        responses: Dict[UploadSource, UploadResponse] = {}
+        pending = []
+        for file, file_size in files:
+            duplicate, digest = await self.find_duplicate(file, file_size, album_id)
+            if duplicate:
+                responses[file] = duplicate
+            else:
+                pending.append((file, file_size, digest, self.new_hasher(file, file_size, digest)))
+
+        sent = await self.send_batch([(x[0], x[1], x[3]) for x in pending], album_id, slot) if len(pending) > 1 else []
+        for i, (file, file_size, digest, hasher) in enumerate(pending):
+            response = sent[i] if sent else None
+            if response:
+                response = await self.check_upload(file, file_size, album_id, response, digest, hasher)
+            if not response or not response.get("success"):
+                response = await self.upload_new(file, file_size, album_id, digest, slot)
+            responses[file] = response
+        return [responses[x[0]] for x in files]
+
+    def file_metadata(self, file: UploadSource, album_id: Optional[str] = None) -> UploadResponse:
+        return {
             "success": False,
             "files": [
                 {
                     "fileName": file.name,
                     "albumid": album_id,
                     "filePath": str(file),
+                    "fileSize": source_size(file),
                     "filePathMD5": hashlib.md5(str(file).encode("utf-8")).hexdigest(),
                     "fileNameMD5": hashlib.md5(str(file.name).encode("utf-8")).hexdigest(),
                     "uploadSuccess": None,
                 }
             ],
         }
-        file_size = os.stat(file).st_size
-        file_mimetype = mimetypes.guess_type(file)[0] or "application/octet-stream"
-        node_response = await self.get_node()
-        if not node_response.get("success"):
-            logger.error(f"Failed to get server to upload to: {pformat(node_response)}")
-            return metadata
-        server = "/".join(node_response["url"].split("/")[:3])
 
-        if server not in self.server_sessions:
-            logger.info(f"Using new server connection to {server}")
-            self.server_sessions[server] = aiohttp.ClientSession(server, headers=self.session_headers)
+    async def send_batch(
+        self,
+        files: List[Tuple[UploadSource, int, Optional[StreamHasher]]],
+        album_id: Optional[str] = None,
+        slot: Optional[AdaptiveLimiter] = None,
+    ) -> List[Optional[UploadResponse]]:
+        """Sends files in one multipart request and returns the response for each file, None for those that failed"""
+        total_size = sum(x[1] for x in files)
+        headers = {"albumid": album_id} if album_id else None
 
-        session = self.server_sessions[server]
+        async with slot or self.file_limiter:
+            server = await self.nodes.get_server()
+            if server is None:
+                return [None] * len(files)
+            session = self.server_session(server)
 
-        headers = {"albumid": album_id} if album_id else None
+            data = aiohttp.FormData()
+            payloads = []
+            for file, file_size, hasher in files:
+                file_mimetype = mimetypes.guess_type(file.name)[0] or "application/octet-stream"
+                payload = self.file_payload(file, 0, file_size, file.name, file_mimetype, server, hasher)
+                payloads.append(payload)
+                data.add_field("files[]", payload, filename=file.name, content_type=file_mimetype)
+
+            started = self.nodes.start(server)
+            uploaded = False
+            for file, file_size, _ in files:
+                self.progress.begin(file, file.name, file_size)
+            try:
+                with self.telemetry.span("batch", node=server, files=len(files), bytes=total_size) as span:
+                    async with session.post(
+                        "/api/upload",
+                        data=data,
+                        headers=headers,
+                        timeout=self.upload_timeout(session, server, total_size),
+                    ) as resp:
+                        response = await response_json(resp, f"Uploading {len(files)} files together to {server}")
+                    span["result"] = "ok"
+                uploaded = True
+                for file, file_size, _ in files:
+                    self.progress.advance(file, file_size)
+            except UploadError as e:
+                # Each file is retried on its own after this so there is no backoff here
+                logger.error(str(e))
+                if e.response:
+                    self.rejected(e.response)
+                return [None] * len(files)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Uploading {len(files)} files together to {server} failed: {e!r}")
+                return [None] * len(files)
+            except Exception:
+                logger.exception(f"Uploading {len(files)} files together to {server} failed")
+                return [None] * len(files)
+            finally:
+                self.finish_request(server, started, uploaded, total_size, "batch")
+                for payload in payloads:
+                    await payload.close()
+                    self.telemetry.observe("disk_wait_seconds", payload.read_wait)
 
-        file_uuid = str(uuid.uuid4())
+        matched = match_files([x[0] for x in files], response.get("files") or [])
+        return [
+            add_metadata({"success": True, "files": [entry]}, self.file_metadata(file, album_id)) if entry else None
+            for (file, _, _), entry in zip(files, matched)
+        ]
+
+    async def send_file(
+        self,
+        file: UploadSource,
+        album_id: Optional[str] = None,
+        hasher: Optional[StreamHasher] = None,
+        slot: Optional[AdaptiveLimiter] = None,
+    ) -> UploadResponse:
+        metadata = self.file_metadata(file, album_id)
+        file_size = source_size(file)
+        file_mimetype = mimetypes.guess_type(file.name)[0] or "application/octet-stream"
+        chunked = file_size > self.chunk_size
+        headers = {"albumid": album_id} if album_id else None
 
-        async with self.sem:
-            retries = 0
-            while retries < self.retries:
+        server: Optional[str] = None
+        acked_chunks: Set[int] = set()
+        retries = 0
+        error: Optional[BaseException] = None
+        while retries < self.retries:
+            if retries:
+                # Backing off happens without holding an upload slot so other files keep using it
+                await self.retry_policy.wait(retries - 1, error)
+            async with slot or self.file_limiter:
+                if server is None:
+                    # Unfinished chunks only exist on the server they were sent to so a resumed upload has to go back
+                    resumable = self.journal.find(file) if chunked and self.journal else None
+                    if resumable and self.nodes.is_healthy(resumable[1]):
+                        server = resumable[1]
+                        logger.info(f"Resuming upload of {file.name} to {server}")
+                    else:
+                        # On the last attempt any node is better than failing the file without trying
+                        server = await self.nodes.get_server(fallback=retries + 1 >= self.retries)
+                        if server is None:
+                            # Every node is left alone for now, waiting for one is an attempt of its own rather than a
+                            # failure of the file
+                            wait = self.nodes.available_in()
+                            error = UploadError("No upload node can be used right now", TRANSIENT, wait)
+                            if wait is not None:
+                                logger.warning(f"Waiting {wait:.0f}s for an upload node to upload {file.name} to")
+                            retries += 1
+                            continue
+                    if chunked:
+                        file_uuid, acked_chunks, chunk_size = self.start_chunks(file, server)
+                elif not acked_chunks and not self.nodes.is_healthy(server):
+                    # A node that keeps failing is swapped out as long as it doesn't hold any chunks of this file
+                    server = await self.nodes.get_server(fallback=True)
+                    if server is None:
+                        return metadata
+                    if chunked:
+                        file_uuid, acked_chunks, chunk_size = self.start_chunks(file, server, file_uuid)
+                session = self.server_session(server)
                 try:
-                    with open(file, "rb") as file_data:
-                        with TqdmUpTo(
-                            unit="B",
-                            unit_scale=True,
-                            unit_divisor=1024,
-                            miniters=1,
-                            desc=f"{file.name} [{retries + 1}/{self.retries}]",
-                        ) as t:
-                            with ProgressFileReader(filename=file, read_callback=t.update_to) as file_data:
-                                if file_size <= self.chunk_size:
-                                    chunk_data = file_data.read(self.chunk_size)
-                                    data = aiohttp.FormData()
-                                    data.add_field(
-                                        "files[]", chunk_data, filename=file.name, content_type=file_mimetype
-                                    )
-
-                                    async with session.post("/api/upload", data=data, headers=headers) as resp:
-                                        response = await resp.json()
-                                        if not response.get("success"):
-                                            raise Exception(f"{file.name} failed uploading without chunks")
-
-                                        return response
-                                else:
-                                    logger.debug(f"{file.name} will use UUID {file_uuid}")
-                                    await self.upload_chunks(
-                                        file_data, file.name, file_uuid, file_size, session, server
-                                    )
-
-                                    upload_data = {
-                                        "files": [
-                                            {
-                                                "uuid": file_uuid,
-                                                "original": file.name,
-                                                "type": file_mimetype,
-                                                "albumid": album_id or "",
-                                                "filelength": "",
-                                                "age": "",
-                                            }
-                                        ]
-                                    }
-                                    finish_chunks_attempt = 0
-                                    while True:
-                                        try:
-                                            async with session.post(
-                                                "/api/upload/finishchunks", json=upload_data
-                                            ) as resp:
-                                                response = await resp.json()
-                                                if response.get("success") is False:
-                                                    msg = f"{file_uuid} failed finishing chunks to {server} [{finish_chunks_attempt + 1}/{self.max_chunk_retries}]\n{pformat(response)}"
-                                                    logger.error(msg)
-                                                    raise Exception(msg)
-                                                # chunk_upload_success = True
-                                                response.update(metadata)
-                                                return response
-                                        except Exception:
-                                            finish_chunks_attempt += 1
-                                            if finish_chunks_attempt >= self.max_chunk_retries:
-                                                raise
-                                    # TODO: Should probably return here
-                except Exception:
-                    logger.exception(f"Upload failed for {file.name} to {server} Attempt #{retries + 1}")
+                    if not chunked:
+                        file_payload = self.file_payload(file, 0, file_size, file.name, file_mimetype, server, hasher)
+                        data = aiohttp.FormData()
+                        data.add_field("files[]", file_payload, filename=file.name, content_type=file_mimetype)
+
+                        started = self.nodes.start(server)
+                        uploaded = False
+                        try:
+                            with self.telemetry.span("upload", node=server, bytes=file_size, file=str(file)) as span:
+                                async with session.post(
+                                    "/api/upload",
+                                    data=data,
+                                    headers=headers,
+                                    timeout=self.upload_timeout(session, server, file_size),
+                                ) as resp:
+                                    response = await response_json(resp, f"Uploading {file.name} to {server}")
+                                span["result"] = "ok"
+                            uploaded = True
+                        except UploadError as e:
+                            if e.response:
+                                self.rejected(e.response)
+                            raise
+                        finally:
+                            self.finish_request(server, started, uploaded, file_size, "file")
+                            self.telemetry.observe("disk_wait_seconds", file_payload.read_wait)
+
+                        self.progress.advance(file, file_size)
+                        return add_metadata(response, metadata)
+                    else:
+                        logger.debug(f"{file.name} will use UUID {file_uuid}")
+                        if acked_chunks:
+                            logger.info(f"{file.name} already has {len(acked_chunks)} chunks uploaded")
+                        self.progress.resumed(
+                            file, sum(min(chunk_size, file_size - x * chunk_size) for x in acked_chunks)
+                        )
+                        await self.upload_chunks(
+                            file,
+                            file.name,
+                            file_uuid,
+                            file_size,
+                            chunk_size,
+                            session,
+                            server,
+                            functools.partial(self.progress.advance, file),
+                            acked_chunks,
+                            hasher,
+                        )
+
+                        upload_data = {
+                            "files": [
+                                {
+                                    "uuid": file_uuid,
+                                    "original": file.name,
+                                    "type": file_mimetype,
+                                    "albumid": album_id or "",
+                                    "filelength": "",
+                                    "age": "",
+                                }
+                            ]
+                        }
+                        response = await self.finish_chunks(session, server, file_uuid, upload_data)
+                        if self.journal:
+                            self.journal.finish(file_uuid)
+                        return add_metadata(response, metadata)
+                except Exception as e:
+                    error = e
+                    kind = classify(e)
+                    if isinstance(e, UploadError):
+                        logger.error(f"Upload failed for {file.name} to {server} Attempt #{retries + 1}: {e}")
+                    else:
+                        logger.exception(f"Upload failed for {file.name} to {server} Attempt #{retries + 1}")
+                    if kind == PERMANENT:
+                        break
+                    self.telemetry.inc("file_retries_total", kind=kind)
+                    if chunked and kind == REJECTED:
+                        # A chunk or finishchunks that keeps being refused means the server may have thrown the
+                        # chunks away so the next attempt starts over
+                        file_uuid, acked_chunks, chunk_size = self.start_chunks(file, server, file_uuid)
                     retries += 1
-            return {"success": False, "files": [{"name": file.name, "url": ""}]}
+        return add_metadata({"success": False, "files": [{"name": file.name, "url": ""}]}, metadata)
+
+    async def finish_chunks(self, session, server: str, file_uuid: str, upload_data: dict) -> UploadResponse:
+        """Asks the server to put the chunks together, this is retried on its own so no chunk is sent again for it"""
+        attempt = 0
+        while True:
+            try:
+                with self.telemetry.span("finish_chunks", node=server, uuid=file_uuid) as span:
+                    async with session.post("/api/upload/finishchunks", json=upload_data) as resp:
+                        response = await response_json(resp, f"Finishing chunks of {file_uuid} on {server}")
+                    span["result"] = "ok"
+                    return response
+            except (UploadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempt += 1
+                logger.error(f"{e!r} [{attempt}/{self.finish_retries}]")
+                if isinstance(e, UploadError) and e.response:
+                    self.rejected(e.response)
+                if classify(e) in (PERMANENT, REJECTED) or attempt >= self.finish_retries:
+                    raise
+                if not self.retry_budget.try_retry(server):
+                    logger.warning(f"Not finishing {file_uuid} again since too many requests to {server} are failing")
+                    raise
+                self.telemetry.inc("finish_retries_total", node=server, kind=classify(e))
+                error = e
+            await self.retry_policy.wait(attempt - 1, error)
 
     # TODO: This should probably move out of API
-    async def upload_files(self, paths: list[Path], folder_id: Optional[str] = None) -> list[UploadResponse]:
+    async def upload_files(
+        self,
+        paths: Union[Iterable[Union[UploadSource, tuple]], AsyncIterable[Union[UploadSource, tuple]]],
+        folder_id: Optional[str] = None,
+        result_callback: Optional[Callable[[UploadResponse], Any]] = None,
+    ) -> Optional[list[UploadResponse]]:
+        """
+        Uploads files with a fixed pool of workers fed from a bounded scheduler so memory stays flat however many paths
+        there are. Paths can come as `(path, size)` to save a stat, or as `(path, size, album_id)` to upload them to
+        another album than `folder_id`. Responses are passed to `result_callback` as they complete or returned all at
+        once without one.
+
+        Besides the regular workers a few only take files small enough to be sent in a single request. They use a
+        chunk request slot instead of a file slot so small files keep the connections busy while large files are
+        waiting on their chunks. Small files are packed together into multi-file requests when batching is enabled.
+        """
+        workers = self.file_limiter.max_limit
+        scheduler = UploadScheduler(self.order, self.priorities, capacity=self.lookahead, small_size=self.chunk_size)
+        self.schedulers.add(scheduler)
+        batch_bytes = self.batch_bytes or self.chunk_size
+        responses = None if result_callback else []
+
+        async def add(item: Union[UploadSource, tuple]) -> None:
+            if not isinstance(item, tuple):
+                item = (item, source_size(item))
+            path, size, album_id = item if len(item) > 2 else (*item, folder_id)
+            self.progress.queued(size)
+            await scheduler.put(path, size, album_id)
+
+        async def produce() -> None:
+            try:
+                if isinstance(paths, AsyncIterable):
+                    async for item in paths:
+                        await add(item)
+                else:
+                    for item in paths:
+                        await add(item)
+            finally:
+                await scheduler.close()
+
+        async def work(small_only: bool = False) -> None:
+            slot = self.chunk_limiter if small_only else None
+            while True:
+                items = await scheduler.get(small_only, self.batch_files, batch_bytes)
+                if items is None:
+                    return
+                album_id = items[0][2]
+                try:
+                    if len(items) > 1:
+                        results = await self.upload_batch([(x[0], x[1]) for x in items], album_id, slot)
+                    else:
+                        results = [await self.upload(items[0][0], album_id, slot)]
+                except Exception:
+                    logger.exception(f"Upload failed for {', '.join(str(x[0]) for x in items)}")
+                    results = [
+                        {"success": False, "files": [{"name": x.name, "filePath": str(x), "fileSize": size, "url": ""}]}
+                        for x, size, _ in items
+                    ]
+                for (path, size, _), response in zip(items, results):
+                    self.progress.completed(path, size, bool(response.get("success")))
+                    self.telemetry.inc("files_total", result=upload_result(response))
+                    if result_callback:
+                        result_callback(response)
+                    else:
+                        responses.append(response)
+
+        tasks = [asyncio.ensure_future(produce())]
+        tasks += [asyncio.ensure_future(work()) for _ in range(workers)]
+        tasks += [asyncio.ensure_future(work(small_only=True)) for _ in range(self.small_file_workers)]
         try:
-            tasks = [self.upload(test_file, folder_id) for i, test_file in enumerate(paths)]
-            responses = await tqdm_asyncio.gather(*tasks, desc="Files uploaded")
-            return responses
+            async with self.progress:
+                await asyncio.gather(*tasks)
         finally:
-            # This should happen in the API client itself
-            await self.session.close()
-            for server_session in self.server_sessions.values():
-                await server_session.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.schedulers.discard(scheduler)
+        return responses
+
+    async def close(self) -> None:
+        # Short runs give refreshes a moment to finish so the next run has them
+        pending = [x for x in self.refreshes.values() if not x.done()]
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=5)
+            for task in pending:
+                task.cancel()
+        await self.pool.close()
+        await self.telemetry.close()
+        await self.shaper.close()
+        self.read_executor.shutdown(wait=False)
+        self.hash_executor.shutdown(wait=False)
+        if self.journal:
+            self.journal.close()
+        if self.hash_index:
+            self.hash_index.close()
+        self.albums.close()
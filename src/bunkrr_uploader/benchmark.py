@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import aiohttp
+
+from .bunkrr_uploader import BunkrrUploader
+from .mock_server import add_arguments, mock_from_args
+from .walker import walk_files
+
+logger = logging.getLogger(__name__)
+
+KiB = 1024
+MiB = 1024**2
+# Groups of files as (count, smallest, biggest) in bytes
+PROFILES = {
+    "small": [(1000, 1 * KiB, 256 * KiB)],
+    "large": [(4, 60 * MiB, 120 * MiB)],
+    "mixed": [(300, 1 * KiB, 512 * KiB), (30, 1 * MiB, 20 * MiB), (3, 40 * MiB, 100 * MiB)],
+}
+# Files per directory of a generated tree
+DIRECTORY_SIZE = 50
+# Whether a bigger value of a metric is better, for comparing with a baseline
+METRICS = {
+    "mibPerSecond": True,
+    "filesPerSecond": True,
+    "seconds": False,
+    "peakRssMiB": False,
+    "chunkLatencyP50": False,
+    "chunkLatencyP99": False,
+    "requests": False,
+    "failedUploads": False,
+}
+# Metrics that only mean something when as many uploads got through as in the baseline
+THROUGHPUT = ("mibPerSecond", "filesPerSecond", "seconds")
+
+
+def make_tree(root: Path, profile: str, seed: int) -> List[Dict[str, Any]]:
+    """
+    Writes the files of a profile below `root/files` with random data from `seed`, or reuses them when they were
+    written before, and returns their names, sizes and MD5s
+    """
+    manifest_path = root / "manifest.json"
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["profile"] == PROFILES[profile] and manifest["seed"] == seed:
+            return manifest["files"]
+
+    rng = random.Random(seed)
+    files = []
+    number = 0
+    for count, smallest, biggest in PROFILES[profile]:
+        for _ in range(count):
+            size = rng.randint(smallest, biggest)
+            path = root / "files" / f"{number // DIRECTORY_SIZE:03d}" / f"{number:05d}.bin"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            md5 = hashlib.md5()
+            with open(path, "wb") as f:
+                remaining = size
+                while remaining:
+                    data = rng.randbytes(min(remaining, MiB))
+                    md5.update(data)
+                    f.write(data)
+                    remaining -= len(data)
+            files.append({"name": path.name, "size": size, "md5": md5.hexdigest()})
+            number += 1
+    manifest_path.write_text(json.dumps({"profile": PROFILES[profile], "seed": seed, "files": files}))
+    return files
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q / 100), len(ordered) - 1)]
+
+
+def peak_rss_mib() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak / MiB if sys.platform == "darwin" else peak / KiB
+
+
+def mock_process(args: argparse.Namespace, urls: Any) -> None:
+    """Runs the mock server in a process of its own so it doesn't take CPU time away from the uploader"""
+
+    async def run() -> None:
+        mock = mock_from_args(args)
+        urls.put(await mock.start())
+        await asyncio.Event().wait()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_options(options: List[str]) -> Dict[str, Any]:
+    """Reads `key=value` options for BunkrrUploader, values are JSON when they can be"""
+    parsed = {}
+    for option in options:
+        key, _, value = option.partition("=")
+        try:
+            parsed[key] = json.loads(value)
+        except ValueError:
+            parsed[key] = value
+    return parsed
+
+
+async def run_once(args: argparse.Namespace, url: str, root: Path, files: List[Dict[str, Any]]) -> Dict[str, Any]:
+    options = {
+        "api_url": url,
+        "use_config": False,
+        "save": False,
+        "progress": "none",
+        "recursive": True,
+        "chunk_connections": args.chunk_connections,
+        "processes": args.processes,
+        **parse_options(args.option),
+    }
+    async with aiohttp.ClientSession(url) as session:
+        async with session.post("/mock/reset"):
+            pass
+
+        client = BunkrrUploader("benchmark", max_connections=args.connections, retries=args.retries, options=options)
+        started = time.monotonic()
+        try:
+            await client.init()
+            folder_id, directory_ids = await client.find_albums(root / "files", "benchmark", True)
+            responses = await client.upload_sources(
+                walk_files(root / "files", recursive=True), folder_id, directory_ids
+            )
+        finally:
+            await client.api.close()
+        seconds = time.monotonic() - started
+
+        async with session.get("/mock/stats") as resp:
+            stats = await resp.json()
+
+    expected = sorted((x["name"], x["size"], x["md5"]) for x in files)
+    received = sorted((x["name"], x["size"], x["md5"]) for x in stats["uploads"])
+    total_size = sum(x["size"] for x in files)
+    # Failed uploads don't count towards throughput, otherwise failing fast would look like a speedup
+    uploaded = [(x.get("files") or [{}])[0] for x in responses if x.get("success")]
+    uploaded_size = sum(int(x.get("fileSize") or 0) for x in uploaded)
+    latencies = stats["chunkLatencies"]
+    return {
+        "seconds": seconds,
+        "files": len(files),
+        "bytes": total_size,
+        "uploadedFiles": len(uploaded),
+        "uploadedBytes": uploaded_size,
+        "mibPerSecond": uploaded_size / MiB / seconds,
+        "filesPerSecond": len(uploaded) / seconds,
+        "peakRssMiB": peak_rss_mib(),
+        "chunkLatencyP50": percentile(latencies, 50) * 1000,
+        "chunkLatencyP99": percentile(latencies, 99) * 1000,
+        "requests": stats["requests"],
+        "failuresInjected": stats["failuresInjected"],
+        "failedUploads": sum(1 for x in responses if not x.get("success")),
+        "reassemblyErrors": stats["reassemblyErrors"],
+        # Uploads of the same file count once, verification is skipped when the mock doesn't keep the data
+        "verified": all(x[2] is None for x in received) or sorted(set(received)) == expected,
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    root = args.tree_dir / f"{args.profile}-{args.seed}"
+    loop = asyncio.get_running_loop()
+    logger.info(f"Preparing {args.profile} files in {root}")
+    files = await loop.run_in_executor(None, make_tree, root, args.profile, args.seed)
+
+    context = multiprocessing.get_context("spawn")
+    urls = context.Queue()
+    server = context.Process(target=mock_process, args=(args, urls), name="bunkrr-mock", daemon=True)
+    server.start()
+    try:
+        url = await loop.run_in_executor(None, lambda: urls.get(timeout=30))
+        runs = []
+        for run in range(args.repeat):
+            result = await run_once(args, url, root, files)
+            logger.info(f"Run {run + 1}/{args.repeat}: {result['mibPerSecond']:.1f}MiB/s in {result['seconds']:.1f}s")
+            runs.append(result)
+    finally:
+        server.terminate()
+        server.join()
+
+    # The median of every metric keeps a single noisy run from skewing the comparison
+    metrics = {key: statistics.median([x[key] for x in runs]) for key in runs[0] if key != "verified"}
+    metrics["verified"] = all(x["verified"] for x in runs)
+    scenario = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("baseline", "output", "tree_dir", "verbose", "repeat")
+    }
+    return {"scenario": scenario, "metrics": metrics, "runs": runs}
+
+
+def compare(metrics: Dict[str, Any], baseline: Dict[str, Any]) -> List[Tuple[str, float, float, float, bool]]:
+    """
+    Returns every metric with its baseline, current value, relative change and whether it got better. Throughput
+    never counts as better when more uploads failed than in the baseline.
+    """
+    more_failures = metrics.get("failedUploads", 0) > baseline.get("failedUploads", 0)
+    rows = []
+    for key, higher_is_better in METRICS.items():
+        before, after = baseline.get(key), metrics.get(key)
+        if before is None or after is None or (not before and key != "failedUploads"):
+            continue
+        if before:
+            change = (after - before) / before
+        else:
+            change = float("inf") if after else 0.0
+        better = change > 0 if higher_is_better else change < 0
+        rows.append((key, before, after, change, better and not (more_failures and key in THROUGHPUT)))
+    return rows
+
+
+def print_report(result: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    metrics = result["metrics"]
+    print(
+        f"{metrics['uploadedFiles']:.0f}/{metrics['files']:.0f} files, {metrics['uploadedBytes'] / MiB:.1f}/"
+        f"{metrics['bytes'] / MiB:.1f}MiB uploaded in {metrics['seconds']:.2f}s: "
+        f"{metrics['mibPerSecond']:.2f}MiB/s, {metrics['filesPerSecond']:.1f} files/s, peak RSS "
+        f"{metrics['peakRssMiB']:.0f}MiB, chunk latency p50 {metrics['chunkLatencyP50']:.0f}ms "
+        f"p99 {metrics['chunkLatencyP99']:.0f}ms"
+    )
+    print(
+        f"{metrics['requests']:.0f} requests, {metrics['failuresInjected']:.0f} failures injected, "
+        f"{metrics['failedUploads']:.0f} failed uploads, {metrics['reassemblyErrors']:.0f} reassembly errors, "
+        f"{'all uploads match' if metrics['verified'] else 'UPLOADS DO NOT MATCH THE LOCAL FILES'}"
+    )
+    if not baseline:
+        return
+    if baseline.get("scenario") != result["scenario"]:
+        print("The baseline was measured with other settings, see its scenario")
+    failed_before = baseline["metrics"].get("failedUploads", 0)
+    if metrics["failedUploads"] != failed_before:
+        print(
+            f"{metrics['failedUploads']:.0f} uploads failed against {failed_before:.0f} in the baseline, throughput "
+            f"only counts the uploads that got through"
+        )
+    print(f"{'metric':<18}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key, before, after, change, better in compare(metrics, baseline["metrics"]):
+        print(
+            f"{key:<18}{before:>12.2f}{after:>12.2f}{change:>+9.1%}{' ' if abs(change) < 0.02 else '+' if better else '-'}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Uploads generated files to the mock server and reports throughput, memory and chunk latency"
+    )
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="mixed", help="Which files to upload")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the file sizes and contents")
+    parser.add_argument(
+        "--tree-dir",
+        type=Path,
+        default=Path("benchmark-files"),
+        help="Where the generated files are kept between runs",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Runs to take the median of")
+    parser.add_argument("-c", "--connections", type=int, default=2, help="Maximum parallel uploads")
+    parser.add_argument("--chunk-connections", type=int, default=3, help="Maximum chunks of a file at once")
+    parser.add_argument("--processes", type=int, default=1, help="Upload processes")
+    parser.add_argument("-r", "--retries", type=int, default=3, help="Attempts per file")
+    parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        help='Any other BunkrrUploader option as key=value, such as order="largest", can be given several times',
+    )
+    parser.add_argument("--output", type=Path, help="Save the results as JSON to compare later runs against")
+    parser.add_argument("--baseline", type=Path, help="Results saved with --output to compare against")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show what the uploader logs")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logger.setLevel(logging.INFO)
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else {}
+    result = asyncio.run(run_benchmark(args))
+    print_report(result, baseline)
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2, default=str))
+    if not result["metrics"]["verified"] or result["metrics"]["reassemblyErrors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 import asyncio
-import csv
 import functools
 import logging
 import os
@@ -7,14 +6,24 @@ import re
 import time
 from pathlib import Path
 from pprint import pformat, pprint
-from typing import Any, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 from .api import BunkrrAPI
 from .cli import cli
+from .daemon import UploadDaemon, submit_job
+from .results import ResultSink, open_sink, record_key, record_size
+from .sharding import ShardedUploader
+from .split import FilePart, UploadSource, split_file, write_manifest
+from .types import UploadResponse
+from .util import get_config_dir
+from .walker import iterate_in_thread, walk_directories, walk_files
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.WARNING)
 
+# Paths of the parts split_file makes, like video.mkv.001
+PART_PATH = re.compile(r"\.\d{3,}$")
+
 
 class BunkrrUploader:
     def __init__(
@@ -28,42 +37,26 @@ class BunkrrUploader:
             options = {}
         self.options = options
         self.api = BunkrrAPI(token, max_connections, retries, options)
+        self.max_connections = max_connections
+        self.retries = retries
         self.temporary_files = []
+        # Files too big for the server that are uploaded in parts
+        self.split_files: Dict[Path, List[FilePart]] = {}
+        self.split_parts: Set[str] = set()
+        self.manifest_dir = options.get("manifest_dir") or get_config_dir() / "manifests"
+        # Path, size and album of files that earlier results say were uploaded already
+        self.recorded: Set[Tuple[str, int, str]] = set()
+        # Their records when they look like split parts, skipped parts still belong in the manifest of their file
+        self.recorded_parts: Dict[Tuple[str, int, str], dict] = {}
 
     async def init(self):
-        raw_req = await self.api.get_check()
-        logger.debug(pformat(raw_req))
-        max_file_size = raw_req.get("maxSize", "0B")
-        max_chunk_size = raw_req.get("chunkSize", {}).get("max", "0B")
-        default_chunk_size = raw_req.get("chunkSize", {}).get("default", "0B")
-        self.api.file_blacklist.extend(raw_req.get("stripTags", {}).get("blacklistExtensions", []))
-
-        # Choose a chunk size, default or max
-        chunk_size = default_chunk_size
-        # chunk_size = '1MB'
-
-        if max_file_size == "0B" or chunk_size == "0B":
-            raise Exception("Invalid max file size or chunk size")
-
-        units_to_calc = [max_file_size, chunk_size]
-        units_calculated = []
-
-        for unit in units_to_calc:
-            size_str = unit.lower()
-            unit_multiplier = {"b": 1, "kb": 1024, "mb": 1024**2, "gb": 1024**3, "tb": 1024**4}
-            match = re.match(r"^(\d+)([a-z]+)$", size_str)
-
-            if match:
-                value, unit = match.groups()
-                bytes_size = int(value) * unit_multiplier.get(unit, 1)
-                units_calculated.append(bytes_size)
-            else:
-                raise ValueError("Invalid input format")
+        # Cached limits are used right away and only the first run has to wait for the server
+        await self.api.load_limits()
+        self.api.check_token()
+        await self.api.telemetry.start()
+        await self.api.shaper.start()
 
-        self.api.max_file_size = units_calculated[0]
-        self.api.chunk_size = units_calculated[1]
-
-    def prepare_file_for_upload(self, file: Path) -> List[Path]:
+    def prepare_file_for_upload(self, file: Path) -> List[Tuple[UploadSource, int]]:
         file_size = os.stat(file).st_size
 
         # TODO: Truncate the file name if it is too long
@@ -74,92 +67,265 @@ class BunkrrUploader:
             return []
 
         if file_size > self.api.max_file_size:
-            # TODO: Create temporary file archive
-            logger.error(f"File {file} is bigger than max file size {self.api.max_file_size}")
-            return []
-
-        return [file]
-
-    async def upload_files(self, path: Path, folder: Optional[str] = None) -> None:
-        if path.is_file():
-            paths = [path]
+            if not self.options.get("split"):
+                logger.error(
+                    f"File {file} is bigger than max file size {self.api.max_file_size}, use --split to upload it"
+                )
+                return []
+            # Ranges of the file are uploaded as parts of their own instead of writing a temporary copy
+            part_size = min(self.options.get("part_size") or self.api.max_file_size, self.api.max_file_size)
+            parts = split_file(file, file_size, part_size)
+            logger.info(f"Splitting {file} into {len(parts)} parts of {part_size} bytes")
+            self.split_files[file] = parts
+            self.split_parts.update(str(x) for x in parts)
+            return [(x, x.size) for x in parts]
+
+        return [(file, file_size)]
+
+    def load_results(self, results: ResultSink) -> None:
+        """
+        Skips the files that saved results say were uploaded to the same album, such as by a run that crashed, and adds
+        their digests to the duplicate index
+        """
+        uploads = []
+        for record in results.uploaded():
+            key = record_key(record.get("filePath"), record.get("fileSize"), record.get("albumid"))
+            self.recorded.add(key)
+            if PART_PATH.search(key[0]):
+                # CSV and SQLite give back uploadSuccess as text
+                success = "duplicate" if record.get("uploadSuccess") == "duplicate" else True
+                self.recorded_parts[key] = {**record, "uploadSuccess": success}
+            if record.get("fileMD5"):
+                size = record_size(record.get("fileSize"))
+                uploads.append((record["fileMD5"], record.get("albumid"), size, record.get("name"), record.get("url")))
+        if uploads and self.api.hash_index:
+            self.api.hash_index.import_uploads(uploads)
+        if self.recorded:
+            logger.info(f"{len(self.recorded)} files were already uploaded according to {results.path}")
+
+    def album_name(self, folder: str, root: Path, directory: Path) -> str:
+        """Subdirectories get an album named after their path below the uploaded directory such as `folder/a/b`"""
+        relative = directory.relative_to(root).as_posix()
+        return folder if relative == "." else f"{folder}/{relative}"
+
+    async def find_albums(
+        self, path: Path, folder: Optional[str], recursive: bool = False, album_per_directory: bool = False
+    ) -> Tuple[Optional[str], Dict[Path, Optional[str]]]:
+        """Returns the album to upload to and, when every directory gets its own album, the album of each directory"""
+        if not folder:
+            return None, {}
+        if self.options.get("refresh_albums"):
+            await self.api.albums.refresh(full=True)
+        if path.is_dir() and recursive and album_per_directory:
+            # Only directories are listed up front so all the missing albums can be created at once
+            loop = asyncio.get_running_loop()
+            directories = await loop.run_in_executor(None, lambda: list(walk_directories(path, recursive)))
+            names = {x: self.album_name(folder, path, x) for x in directories}
+            album_ids = await self.api.albums.get_ids(list(set(names.values())))
+            directory_ids = {x: album_ids[name] for x, name in names.items()}
+            return directory_ids[path], directory_ids
+        return await self.api.albums.get_id(folder), {}
+
+    async def upload_sources(
+        self,
+        files: Iterator[Path],
+        folder_id: Optional[str] = None,
+        directory_ids: Optional[Dict[Path, Optional[str]]] = None,
+        result_callback: Optional[Callable[[UploadResponse], Any]] = None,
+    ) -> List[UploadResponse]:
+        """
+        Uploads the files, splitting or skipping the ones the server won't take. Responses are passed to
+        `result_callback` as they complete or returned all at once without one.
+        """
+        directory_ids = directory_ids or {}
+        responses = None if result_callback else []
+        # Only the responses of split parts are kept, for their manifests
+        uploaded_parts: Dict[str, dict] = {}
+
+        def prepare(file: Path) -> List[Tuple[UploadSource, int, Optional[str]]]:
+            album_id = directory_ids.get(file.parent, folder_id)
+            items = []
+            try:
+                sources = self.prepare_file_for_upload(file)
+            except OSError as e:
+                # Deleted or made unreadable since it was listed, the other files are still uploaded
+                logger.error(f"Skipping {file} because it can't be read anymore: {e}")
+                return []
+            for x, size in sources:
+                key = record_key(x, size, album_id)
+                if key in self.recorded:
+                    logger.info(f"Skipping {x} because the results say it was already uploaded")
+                    if isinstance(x, FilePart):
+                        uploaded_parts[str(x)] = self.recorded_parts[key]
+                    continue
+                items.append((x, size, album_id))
+            return items
+
+        def collect(response: UploadResponse) -> None:
+            uploaded = (response.get("files") or [{}])[0] or {}
+            if uploaded.get("filePath") in self.split_parts:
+                uploaded_parts[uploaded["filePath"]] = uploaded
+            if result_callback:
+                result_callback(response)
+            else:
+                responses.append(response)
+
+        # Files are found lazily in a thread and the ones the server won't accept are filtered out along the way, their
+        # sizes and albums are kept for the scheduler
+        items = iterate_in_thread(files, prepare)
+        processes = self.options.get("processes") or 1
+        if processes > 1:
+            sharded = ShardedUploader(
+                self.api.token, self.max_connections, self.retries, self.options, processes, self.api.progress
+            )
+            await sharded.upload_files(items, collect)
         else:
-            paths = [x for x in path.iterdir() if x.is_file()]
-            if folder is None:
-                folder = path.name
+            await self.api.upload_files(items, folder_id, collect)
 
-        # The server may not accept certain file types and those over a certain size so we need to create temporary files
-        filtered_paths = []
-        for file_path in paths:
-            filtered_paths.extend(self.prepare_file_for_upload(file_path))
+        for file, parts in list(self.split_files.items()):
+            if any(str(x) in uploaded_parts for x in parts):
+                try:
+                    write_manifest(file, parts, uploaded_parts, self.manifest_dir)
+                except OSError as e:
+                    logger.error(f"Unable to save the manifest to join the parts of {file}: {e}")
+                del self.split_files[file]
+        return responses
 
-        if len(paths) == 0:
-            print("No file paths left to upload")
-            return
-
-        # TODO: Delete the extra created files after upload
-        self.temporary_files = [x for x in filtered_paths if x not in paths]
-
-        folder_id = None
-        if folder:
-            # ← patched: fetch *all* album pages so names beyond #50 aren’t missed
-            all_albums = []
-            page = 1
-            while True:
-                resp = await self.api.session.get(f"/api/albums?page={page}")
-                data = await resp.json()
-                all_albums.extend(data["albums"])
-                if len(data["albums"]) < 50:
-                    break
-                page += 1
-
-            existing_folder = next((x for x in all_albums if x["name"] == folder), None)
-
-            if existing_folder:
-                folder_id = str(existing_folder["id"])
+    async def upload_files(self, path: Path, folder: Optional[str] = None) -> None:
+        if path.is_dir() and folder is None:
+            folder = path.name
+        recursive = self.options.get("recursive", False)
+
+        folder_id, directory_ids = await self.find_albums(
+            path, folder, recursive, self.options.get("album_per_directory", False)
+        )
+        results = open_results(self.options)
+        if results:
+            self.load_results(results)
+        count = 0
+
+        def save(response: UploadResponse) -> None:
+            nonlocal count
+            count += 1
+            if results:
+                results.write(response)
             else:
-                created_folder = await self.api.create_album(folder, folder)
-                folder_id = str(created_folder["id"])
-
-        if paths:
-            responses = await self.api.upload_files(filtered_paths, folder_id)
-            # pprint(responses)
-
-            if self.options.get("save") is True and responses:
-                expected_fieldnames = ["albumid", "filePathMD5", "fileNameMD5", "filePath", "fileName", "uploadSuccess"]
-                response_fields = list(set(expected_fieldnames + list(set().union(*[x.keys() for x in responses[0]["files"] if x]))))
+                pprint(response)
+
+        try:
+            await self.upload_sources(walk_files(path, recursive=recursive), folder_id, directory_ids, save)
+        finally:
+            if results:
+                results.close()
+                logger.info(f"Saved {results.written} results to {results.path}")
+        if not count:
+            print("No file paths left to upload")
 
-                file_name = f"bunkrr_upload_{int(time.time())}.csv"
-                with open(file_name, "w", newline="") as csvfile:
-                    logger.info(f"Saving uploaded files to {file_name}")
-                    csv_writer = csv.DictWriter(csvfile, dialect="excel", fieldnames=response_fields)
-                    csv_writer.writeheader()
-                    for row in responses:
-                        csv_writer.writerow(row["files"][0])
 
-            else:
-                pprint(responses)
+def open_results(options: Dict[str, Any]) -> Optional[ResultSink]:
+    """Results are appended to --results or, when saving, a new bunkrr_upload_<unixtime>.csv"""
+    path = options.get("results")
+    if path is None:
+        if options.get("save") is not True:
+            return None
+        path = f"bunkrr_upload_{int(time.time())}.csv"
+    return open_sink(Path(path), options.get("results_format"))
 
 
 async def async_main() -> None:
     args = cli()
     logger.debug(args)
 
-    options = {"save": args.save, "chunk_retries": args.chunk_retries}
+    options = {
+        "save": args.save,
+        "api_url": args.api_url,
+        "chunk_retries": args.chunk_retries,
+        "finish_retries": args.finish_retries,
+        "retry_backoff": args.retry_backoff,
+        "chunk_connections": args.chunk_connections,
+        "fixed_concurrency": args.fixed_concurrency,
+        "hedge_percentile": args.hedge_percentile,
+        "max_hedges": args.max_hedges,
+        "max_chunk_size": args.max_chunk_size,
+        "recursive": args.recursive,
+        "order": args.order,
+        "priorities": args.priority,
+        "lookahead": args.lookahead,
+        "small_file_workers": args.small_file_workers,
+        "batch_files": args.batch_files,
+        "batch_bytes": args.batch_bytes,
+        "split": args.split,
+        "album_per_directory": args.album_per_directory,
+        "refresh_albums": args.refresh_albums,
+        "state_ttl": args.state_ttl,
+        "processes": args.processes,
+        "part_size": args.part_size,
+        "read_ahead": args.read_ahead,
+        "node_ttl": args.node_ttl,
+        "pool_limit": args.pool_limit,
+        "pool_limit_per_host": args.pool_limit_per_host,
+        "dns_cache_ttl": args.dns_cache_ttl,
+        "keepalive_timeout": args.keepalive_timeout,
+        "io_threads": args.io_threads,
+        "hash_threads": args.hash_threads,
+        "extra_hashes": args.extra_hash,
+        "use_config": args.use_config,
+        "results": args.results,
+        "results_format": args.results_format,
+        "progress": args.progress,
+        "progress_interval": args.progress_interval,
+        "progress_files": args.progress_files,
+        "trace": args.trace,
+        "metrics_file": args.metrics_file,
+        "metrics_port": args.metrics_port,
+        "max_bandwidth": args.max_bandwidth,
+        "node_bandwidth": args.node_bandwidth,
+        "bandwidth_schedule": args.bandwidth_schedule,
+        "bandwidth_file": args.bandwidth_file,
+        "manifest_dir": args.manifest_dir,
+    }
+
+    socket_path = args.socket or get_config_dir() / "daemon.sock"
+    secret_path = get_config_dir() / "daemon.secret"
+    if args.submit:
+        results = open_results(options)
+        try:
+            await submit_job(
+                args.file,
+                args.folder,
+                socket_path,
+                port=args.port,
+                recursive=args.recursive or None,
+                album_per_directory=args.album_per_directory or None,
+                result_callback=results.write if results else None,
+                secret_path=secret_path,
+            )
+        finally:
+            if results:
+                results.close()
+        return
 
     bunkrr_client = BunkrrUploader(args.token, max_connections=args.connections, retries=args.retries, options=options)
     try:
         await bunkrr_client.init()
-        if args.dry_run:
+        if args.daemon:
+            daemon = UploadDaemon(
+                bunkrr_client,
+                socket_path,
+                port=args.port,
+                secret_path=secret_path,
+                allowed_roots=args.allow_path,
+                results=open_results(options),
+            )
+            for path in args.watch:
+                daemon.watch(path, args.folder, args.settle)
+            await daemon.serve()
+        elif args.dry_run:
             print("Dry run only, uploading skipped")
         else:
             await bunkrr_client.upload_files(args.file, folder=args.folder)
     finally:
-        if not bunkrr_client.api.session.closed:
-            await bunkrr_client.api.session.close()
-        for server_session in bunkrr_client.api.server_sessions.values():
-            if not server_session.closed:
-                server_session.close()
+        await bunkrr_client.api.close()
 
 
 def main():
@@ -0,0 +1,75 @@
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class NodeChunkSize:
+    def __init__(self, size: int):
+        self.size = size
+        self.throughput: Optional[float] = None
+        self.successes = 0
+
+
+class ChunkSizePolicy:
+    """
+    Picks the chunk size for each node between the server's default and maximum chunk size.
+
+    Every node starts at the default, or the maximum with --max-chunk-size, and the size then follows the node's
+    measured throughput so a chunk takes about `target_seconds` to send. A failed or slow chunk halves the size so
+    less has to be sent again on lossy links. The target is kept well under the server's chunk timeout.
+    """
+
+    # How much weight new measurements get in the throughput average
+    smoothing = 0.3
+    # Successful chunks needed at a size before it may grow again
+    probe_chunks = 2
+
+    def __init__(
+        self,
+        default_size: int,
+        max_size: int,
+        timeout: Optional[float] = None,
+        start_with_max: bool = False,
+        target_seconds: float = 10.0,
+    ):
+        self.min_size = default_size
+        self.max_size = max(max_size, default_size)
+        self.initial_size = self.max_size if start_with_max else self.min_size
+        # Chunks have to arrive well before the server gives up on the upload
+        self.target_seconds = min(target_seconds, timeout / 10) if timeout else target_seconds
+        self.nodes: Dict[str, NodeChunkSize] = {}
+
+    def _node(self, server: str) -> NodeChunkSize:
+        if server not in self.nodes:
+            self.nodes[server] = NodeChunkSize(self.initial_size)
+        return self.nodes[server]
+
+    def size_for(self, server: str) -> int:
+        return self._node(server).size
+
+    def _set_size(self, server: str, node: NodeChunkSize, size: int, reason: str) -> None:
+        size = min(max(size, self.min_size), self.max_size)
+        if size != node.size:
+            logger.info(f"Changing chunk size for {server} from {node.size} to {size}: {reason}")
+            node.size = size
+            node.successes = 0
+
+    def record(self, server: str, length: int, seconds: float, success: bool) -> None:
+        node = self._node(server)
+        if not success:
+            self._set_size(server, node, node.size // 2, "a chunk failed")
+            return
+
+        if seconds <= 0:
+            return
+        throughput = length / seconds
+        node.throughput = (
+            throughput if node.throughput is None else node.throughput + self.smoothing * (throughput - node.throughput)
+        )
+        node.successes += 1
+
+        if seconds > self.target_seconds * 2:
+            self._set_size(server, node, node.size // 2, f"a chunk took {seconds:.1f}s")
+        elif node.successes >= self.probe_chunks and node.throughput * self.target_seconds >= node.size * 2:
+            self._set_size(server, node, node.size * 2, f"throughput is {node.throughput / 1024**2:.1f}MiB/s")
@@ -2,10 +2,17 @@ import argparse
 import os
 from pathlib import Path
 
+from .progress import MODES
+from .results import FORMATS
+from .scheduler import POLICIES
+from .shaping import parse_node_rate, parse_rate, parse_schedule
+
 
 def cli():
     parser = argparse.ArgumentParser(prog="bunkrr-upload", description="Bunkrr Uploader supporting parallel uploads")
-    parser.add_argument("file", type=Path, help="File or directory to look for files in to upload")
+    parser.add_argument(
+        "file", type=Path, nargs="?", help="File or directory to look for files in to upload, not needed for --daemon"
+    )
     parser.add_argument(
         "-t",
         "--token",
@@ -17,6 +24,115 @@ def cli():
     parser.add_argument(
         "-f", "--folder", type=str, help="Folder to upload files to overriding the directory name if used"
     )
+    parser.add_argument(
+        "-R",
+        "--recursive",
+        action="store_true",
+        help="Also upload the files in every subdirectory of the directory",
+    )
+    parser.add_argument(
+        "--album-per-directory",
+        action="store_true",
+        help="With --recursive upload every subdirectory to its own album named after its path such as folder/sub/dir",
+    )
+    parser.add_argument(
+        "--refresh-albums",
+        action="store_true",
+        help="Reload every album of the account instead of only looking for new ones, to forget deleted albums",
+    )
+    parser.add_argument(
+        "--order",
+        choices=POLICIES,
+        default="fifo",
+        help="""Order to upload files in, largest first finishes a batch soonest and smallest first finishes the most
+                files early""",
+    )
+    parser.add_argument(
+        "--priority",
+        action="append",
+        default=[],
+        help="Glob of paths or file names to upload before everything else, can be given several times in order",
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=1000,
+        help="How many found files to hold for ordering before waiting for uploads to finish",
+    )
+    parser.add_argument(
+        "--small-file-workers",
+        type=int,
+        default=2,
+        help="Extra workers that only upload files small enough for a single request while large files are chunking",
+    )
+    parser.add_argument(
+        "--batch-files",
+        type=int,
+        default=10,
+        help="Most small files to send together in a single request, 1 to send every file on its own",
+    )
+    parser.add_argument(
+        "--batch-bytes",
+        type=int,
+        help="Most bytes of small files to send together in a single request, defaults to the server's chunk size",
+    )
+    parser.add_argument(
+        "--split",
+        action="store_true",
+        help="Upload files bigger than the server's max file size as numbered parts along with a manifest to join them",
+    )
+    parser.add_argument(
+        "--manifest-dir",
+        type=Path,
+        help="Directory to save the manifests of split files in, the config directory by default",
+    )
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        help="Size in bytes of the parts of split files, defaults to the server's max file size",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and accept upload jobs from --submit instead of uploading once",
+    )
+    parser.add_argument(
+        "--submit",
+        action="store_true",
+        help="Hand the upload to a running --daemon and print the results as they come in",
+    )
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        help="Unix socket the daemon listens on, defaults to $HOME/.config/bunkrr_upload/daemon.sock",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="Have the daemon listen on this local port instead of a Unix socket, clients need the secret it writes to "
+        "$HOME/.config/bunkrr_upload/daemon.secret",
+    )
+    parser.add_argument(
+        "--allow-path",
+        type=Path,
+        action="append",
+        default=[],
+        help="Directory jobs submitted to the daemon may upload files from, defaults to your home directory. Can be "
+        "given several times",
+    )
+    parser.add_argument(
+        "--watch",
+        type=Path,
+        action="append",
+        default=[],
+        help="Directory the daemon uploads new files from once they stop changing, can be given several times",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=10,
+        help="Seconds a watched file has to stay unchanged before it is uploaded",
+    )
     parser.add_argument(
         "-d",
         "--dry-run",
@@ -26,9 +142,76 @@ def cli():
     parser.add_argument(
         "--max-chunk-size",
         action="store_true",
-        help="Use the server's maximum chunk size instead of the default one",
+        help="Start every node at the server's maximum chunk size instead of the default one before adapting it",
     )
     parser.add_argument("-c", "--connections", type=int, default=2, help="Maximum parallel uploads to do at once")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Worker processes to spread files over when one core can't keep up, each uses up to --connections",
+    )
+    parser.add_argument(
+        "--fixed-concurrency",
+        action="store_true",
+        help="Always use all --connections and --chunk-connections instead of adapting to the measured throughput",
+    )
+    parser.add_argument(
+        "--chunk-connections",
+        type=int,
+        default=3,
+        help="Maximum chunks of a single file to upload at once",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=95,
+        help="Send a duplicate of a chunk that is slower than this percentile of recent chunks to the node, 0 to never",
+    )
+    parser.add_argument(
+        "--max-hedges", type=int, default=2, help="Most duplicate chunks to have in flight at the same time"
+    )
+    parser.add_argument(
+        "--api-url",
+        default="https://app.bunkrr.su",
+        help="Base URL of the API, such as http://127.0.0.1:8080 for python -m bunkrr_uploader.mock_server",
+    )
+    parser.add_argument("--pool-limit", type=int, default=100, help="Maximum open connections across all hosts")
+    parser.add_argument(
+        "--pool-limit-per-host", type=int, default=0, help="Maximum open connections to a single host, 0 for no limit"
+    )
+    parser.add_argument("--dns-cache-ttl", type=int, default=300, help="Seconds to cache DNS lookups for")
+    parser.add_argument(
+        "--keepalive-timeout", type=float, default=60, help="Seconds to keep idle connections open for reuse"
+    )
+    parser.add_argument(
+        "--state-ttl",
+        type=float,
+        default=3600,
+        help="Seconds to trust the cached server limits and token status for before checking them again",
+    )
+    parser.add_argument(
+        "--node-ttl",
+        type=float,
+        default=600,
+        help="Seconds to keep using the upload nodes returned by the API before asking for new ones",
+    )
+    parser.add_argument(
+        "--read-ahead",
+        type=int,
+        default=2,
+        help="How many blocks of each upload to read from disk ahead of the one being sent",
+    )
+    parser.add_argument("--io-threads", type=int, default=4, help="Threads used to read files from disk")
+    parser.add_argument(
+        "--extra-hash",
+        action="append",
+        default=[],
+        help="Another hash to compute while uploading besides MD5, any hashlib algorithm or xxh3_64 if xxhash is installed",
+    )
+    parser.add_argument(
+        "--hash-threads", type=int, default=2, help="Threads used to hash files for duplicate detection"
+    )
     parser.add_argument(
         "--public",
         action=argparse.BooleanOptionalAction,
@@ -41,11 +224,22 @@ def cli():
         default=True,
         help='Don\'t save uploaded file urls to a "gofile_upload_<unixtime>.csv" file',
     )
+    parser.add_argument(
+        "--results",
+        type=Path,
+        help="Append the result of every upload to this file as it finishes instead of a new CSV per run. Files it "
+        "says were uploaded to the same album are skipped, so a run that stopped can be started again",
+    )
+    parser.add_argument(
+        "--results-format",
+        choices=FORMATS,
+        help="Format of --results, by default csv, jsonl or sqlite depending on its extension",
+    )
     parser.add_argument(
         "--use-config",
         action=argparse.BooleanOptionalAction,
         default=True,
-        help="Whether to create and use a config file in $HOME/.config/gofile_upload/config.json",
+        help="Whether to create and use config files in $HOME/.config/bunkrr_upload/ such as the upload journal",
     )
     parser.add_argument(
         "-r",
@@ -56,10 +250,65 @@ def cli():
     )
     parser.add_argument(
         "--chunk-retries",
-        default=1,
+        default=3,
+        type=int,
+        help="How many times to try sending a chunk before the whole file is tried again",
+    )
+    parser.add_argument(
+        "--finish-retries",
+        default=3,
         type=int,
-        help="How many times to retry a failed chunk or chunk completion",
+        help="How many times to try putting the chunks of a file together before the whole file is tried again",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        default=0.5,
+        type=float,
+        help="Seconds to wait before the first retry, doubling with every retry after that",
+    )
+    parser.add_argument(
+        "--progress",
+        choices=MODES,
+        default="auto",
+        help="How to show progress: a display on the terminal, summary lines, JSON lines or nothing, "
+        "auto shows the display on a terminal and summary lines otherwise",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        help="Seconds between progress updates, 0.5 for the display and 30 otherwise by default",
+    )
+    parser.add_argument("--progress-files", type=int, default=5, help="How many uploading files progress shows")
+    parser.add_argument("--trace", type=Path, help="Write a JSON line for every request and its timing to this file")
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="Keep Prometheus metrics in this file, such as for the node_exporter textfile collector",
+    )
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument(
+        "--max-bandwidth",
+        type=parse_rate,
+        help="Most bytes per second to upload in total, such as 20MB, split between the processes of --processes",
+    )
+    parser.add_argument(
+        "--node-bandwidth",
+        type=parse_node_rate,
+        action="append",
+        help="Most bytes per second to upload to each node like 5MB, or to one node like host=2MB. Can be repeated",
+    )
+    parser.add_argument(
+        "--bandwidth-schedule",
+        type=parse_schedule,
+        help="Total bandwidth by time of day overriding --max-bandwidth, such as 08:00=5MB,20:00=0 where 0 is unlimited",
+    )
+    parser.add_argument(
+        "--bandwidth-file",
+        type=Path,
+        help="JSON file with bandwidth limits that is read again when it changes or on SIGHUP, see the README",
     )
     args = parser.parse_args()
+    if args.file is None and not args.daemon:
+        parser.error("the file argument is required unless running with --daemon")
 
     return args
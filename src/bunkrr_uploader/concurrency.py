@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def size_class(size: int) -> int:
+    """Requests within about a factor of 4 in size share a class, their latency per byte is comparable"""
+    return size.bit_length() // 2
+
+
+class AdaptiveLimiter:
+    """
+    A semaphore whose limit follows the measured goodput instead of staying fixed.
+
+    Every `interval` seconds the bytes acknowledged, the failure rate and the latency of finished requests are looked
+    at. Failures and latency well above the best seen for the same kind and size of request shrink the limit
+    multiplicatively. While all slots are busy the limit grows, doubling at first and then one at a time once the
+    first decrease happened, and an increase that didn't improve goodput is taken back.
+    The limit never goes above `max_limit`.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        name: str = "uploads",
+        min_limit: int = 1,
+        initial: Optional[int] = None,
+        interval: float = 5.0,
+        adaptive: bool = True,
+        max_failure_rate: float = 0.1,
+        decrease_factor: float = 0.7,
+        max_latency_ratio: float = 2.5,
+    ):
+        self.name = name
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = min(max(min_limit, 1), self.max_limit)
+        self.adaptive = adaptive
+        if not adaptive:
+            initial = self.max_limit
+        self.limit = float(min(max(initial or self.min_limit, self.min_limit), self.max_limit))
+        self.interval = interval
+        self.max_failure_rate = max_failure_rate
+        self.decrease_factor = decrease_factor
+        self.max_latency_ratio = max_latency_ratio
+
+        self.active = 0
+        self._condition = asyncio.Condition()
+        self._slow_start = True
+        self._saturated = False
+        self._last_change = 0
+        self._previous_goodput: Optional[float] = None
+        # Best latency per byte seen for every kind and size class of request
+        self._min_latency: Dict[Tuple[Hashable, int], float] = {}
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now: float) -> None:
+        self._window_start = now
+        self._bytes = 0
+        self._successes = 0
+        self._failures = 0
+        self._latency: Dict[Tuple[Hashable, int], List[float]] = {}
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+            if self.active >= int(self.limit):
+                self._saturated = True
+
+    async def release(self) -> None:
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.release()
+
+    def record(self, success: bool, size: int = 0, seconds: float = 0.0, kind: Hashable = None) -> None:
+        """Reports how a single upload request went, only requests of the same `kind` and size class are compared"""
+        if success:
+            self._successes += 1
+            self._bytes += size
+            if size and seconds > 0:
+                key = (kind, size_class(size))
+                per_byte = seconds / size
+                window = self._latency.setdefault(key, [0.0, 0])
+                window[0] += per_byte
+                window[1] += 1
+                if key not in self._min_latency or per_byte < self._min_latency[key]:
+                    self._min_latency[key] = per_byte
+        else:
+            self._failures += 1
+
+        now = time.monotonic()
+        if self.adaptive and now - self._window_start >= self.interval:
+            self._adjust(now)
+
+    def _set_limit(self, limit: float, reason: str) -> None:
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if int(limit) != int(self.limit):
+            logger.info(f"Changing {self.name} concurrency from {int(self.limit)} to {int(limit)}: {reason}")
+            self._last_change = int(limit) - int(self.limit)
+        self.limit = limit
+        # Waiters need to check the new limit
+        asyncio.ensure_future(self._notify_all())
+
+    async def _notify_all(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _adjust(self, now: float) -> None:
+        elapsed = now - self._window_start
+        total = self._successes + self._failures
+        goodput = self._bytes / elapsed if elapsed else 0.0
+        failure_rate = self._failures / total if total else 0.0
+        latency_ratio = None
+        # Each class is measured against its own best and weighted by how many requests it had
+        ratios = [(summed / self._min_latency[key], count) for key, (summed, count) in self._latency.items()]
+        counted = sum(count for _, count in ratios)
+        if counted:
+            latency_ratio = sum(ratio for ratio, _ in ratios) / counted
+
+        if total == 0:
+            pass
+        elif failure_rate > self.max_failure_rate:
+            self._slow_start = False
+            self._set_limit(self.limit * self.decrease_factor, f"{failure_rate:.0%} of requests failed")
+        elif latency_ratio is not None and latency_ratio > self.max_latency_ratio:
+            self._slow_start = False
+            self._set_limit(self.limit * self.decrease_factor, f"latency is {latency_ratio:.1f}x the best seen")
+        elif self._previous_goodput is not None and goodput < self._previous_goodput * 1.05 and self._last_change > 0:
+            # The last increase didn't buy any goodput so the link is already full
+            self._slow_start = False
+            self._set_limit(
+                self.limit - self._last_change, f"goodput stayed at {goodput / 1024**2:.1f}MiB/s after increasing"
+            )
+        elif self._saturated:
+            if self._slow_start:
+                self._set_limit(self.limit * 2, f"goodput is {goodput / 1024**2:.1f}MiB/s")
+            else:
+                self._set_limit(self.limit + 1, f"goodput is {goodput / 1024**2:.1f}MiB/s")
+        else:
+            self._last_change = 0
+
+        if total:
+            self._previous_goodput = goodput
+        self._saturated = self.active >= int(self.limit)
+        self._reset_window(now)
@@ -0,0 +1,71 @@
+import logging
+import ssl
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    One connector shared by the API session and every upload node session.
+
+    Connections are kept alive and reused across sessions, DNS lookups are cached and a single SSL context is shared
+    by every TLS connection. Sessions created here don't own the connector so closing one never drops the
+    connections of the others.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        dns_cache_ttl: int = 300,
+        keepalive_timeout: float = 60,
+        headers: Optional[Dict[str, str]] = None,
+        trace_configs: Optional[List[aiohttp.TraceConfig]] = None,
+    ):
+        self.headers = headers or {}
+        self.trace_configs = trace_configs
+        self.ssl_context = ssl.create_default_context()
+        self.connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=dns_cache_ttl,
+            keepalive_timeout=keepalive_timeout,
+            ssl=self.ssl_context,
+        )
+        self.sessions: List[aiohttp.ClientSession] = []
+
+    def session(self, base_url: Optional[str] = None, **kwargs: Any) -> aiohttp.ClientSession:
+        session = aiohttp.ClientSession(
+            base_url,
+            connector=self.connector,
+            connector_owner=False,
+            headers=self.headers,
+            trace_configs=self.trace_configs,
+            **kwargs,
+        )
+        self.sessions.append(session)
+        return session
+
+    def stats(self) -> Dict[str, Any]:
+        # aiohttp doesn't expose these publicly so they are read defensively
+        acquired = getattr(self.connector, "_acquired", set())
+        idle = getattr(self.connector, "_conns", {})
+        return {
+            "limit": self.connector.limit,
+            "limitPerHost": self.connector.limit_per_host,
+            "active": len(acquired),
+            "idle": sum(len(x) for x in idle.values()),
+            "idleByHost": {f"{key.host}:{key.port}": len(x) for key, x in idle.items()},
+            "sessions": len(self.sessions),
+        }
+
+    async def close(self) -> None:
+        logger.debug(f"Closing connection pool {self.stats()}")
+        for session in self.sessions:
+            if not session.closed:
+                await session.close()
+        await self.connector.close()
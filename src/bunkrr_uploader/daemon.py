@@ -0,0 +1,362 @@
+import asyncio
+import functools
+import hmac
+import itertools
+import json
+import logging
+import os
+import secrets
+import time
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+import aiohttp
+from aiohttp import web
+
+from .results import ResultSink
+from .types import UploadResponse
+from .walker import walk_files
+from .watcher import DirectoryWatcher
+
+if TYPE_CHECKING:
+    from .bunkrr_uploader import BunkrrUploader
+
+logger = logging.getLogger(__name__)
+
+
+def create_secret(path: Path) -> str:
+    """Writes a new random secret to a file only the user running the daemon can read"""
+    secret = secrets.token_urlsafe(32)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        path.unlink()
+    # Created with its final mode so it is never readable by anyone else, not even for a moment
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(secret)
+    return secret
+
+
+class Job:
+    def __init__(self, job_id: int, path: Path, folder: Optional[str]):
+        self.id = job_id
+        self.path = path
+        self.folder = folder
+        self.status = "running"
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.uploaded = 0
+        self.failed = 0
+        self.listeners: List[asyncio.Queue] = []
+
+    def add_result(self, response: UploadResponse) -> None:
+        if response.get("success"):
+            self.uploaded += 1
+        else:
+            self.failed += 1
+        for listener in self.listeners:
+            listener.put_nowait({"type": "result", "response": response})
+
+    def finish(self, status: str, error: Optional[str] = None) -> None:
+        self.status = status
+        self.finished = time.time()
+        for listener in self.listeners:
+            listener.put_nowait({"type": "done", **self.summary(), "error": error})
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "path": str(self.path),
+            "folder": self.folder,
+            "status": self.status,
+            "started": self.started,
+            "finished": self.finished,
+            "uploaded": self.uploaded,
+            "failed": self.failed,
+        }
+
+
+class UploadDaemon:
+    """
+    Keeps a BunkrrUploader running so connections, upload nodes, limits and albums stay warm between uploads.
+
+    Jobs are submitted over HTTP on a Unix socket or a local port. POST /jobs with `{"path": ..., "folder": ...}`
+    uploads like a regular run and streams every result back as a line of JSON, GET /jobs lists the jobs. Watched
+    directories are uploaded to as soon as new files stop changing. Jobs run side by side and share the connection
+    limits.
+
+    Only the user running the daemon can use the socket. On a port, which every local user can reach, requests need
+    `Authorization: Bearer <secret>` with the secret the daemon writes to `secret_path`. Submitted jobs can only upload
+    files within `allowed_roots`.
+
+    The result of every upload, including those from watched directories which nobody listens to, is saved to
+    `results` like in a regular run.
+    """
+
+    # Seconds between checks of the cached server limits and token status
+    maintenance_interval = 60
+
+    def __init__(
+        self,
+        client: "BunkrrUploader",
+        socket_path: Optional[Path] = None,
+        host: str = "127.0.0.1",
+        port: Optional[int] = None,
+        history: int = 100,
+        secret_path: Optional[Path] = None,
+        allowed_roots: Optional[List[Path]] = None,
+        results: Optional[ResultSink] = None,
+    ):
+        self.client = client
+        self.results = results
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.history = history
+        self.secret_path = secret_path
+        self.secret: Optional[str] = None
+        self.allowed_roots = [x.expanduser().resolve() for x in allowed_roots or [Path.home()]]
+        self.jobs: Dict[int, Job] = {}
+        self._job_ids = itertools.count(1)
+        self._tasks: List[asyncio.Future] = []
+
+        self.app = web.Application(middlewares=[self.authenticate])
+        self.app.router.add_post("/jobs", self.submit)
+        self.app.router.add_get("/jobs", self.list_jobs)
+        self.app.router.add_get("/jobs/{id}", self.get_job)
+
+    @web.middleware
+    async def authenticate(
+        self, request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]
+    ) -> web.StreamResponse:
+        if self.secret is not None:
+            given = request.headers.get("Authorization", "")
+            if not hmac.compare_digest(given.encode("utf-8"), f"Bearer {self.secret}".encode("utf-8")):
+                return web.json_response({"error": "Missing or wrong secret"}, status=401)
+        return await handler(request)
+
+    def allowed(self, path: Path) -> bool:
+        """Whether a resolved path is within a directory submitted jobs may upload from"""
+        return any(path == root or path.is_relative_to(root) for root in self.allowed_roots)
+
+    def allowed_files(self, paths: Iterator[Path]) -> Iterator[Path]:
+        # Symlinks can point anywhere so every file is checked where it really is
+        for path in paths:
+            if self.allowed(path.resolve()):
+                yield path
+            else:
+                logger.warning(f"Not uploading {path} since it links outside of the allowed directories")
+
+    def save_result(self, job: Job, response: UploadResponse) -> None:
+        job.add_result(response)
+        if self.results:
+            self.results.write(response)
+
+    def new_job(self, path: Path, folder: Optional[str]) -> Job:
+        job = Job(next(self._job_ids), path, folder)
+        self.jobs[job.id] = job
+        # Only the latest finished jobs are remembered
+        finished = [x for x in self.jobs.values() if x.status != "running"]
+        for old in finished[: max(len(finished) - self.history, 0)]:
+            del self.jobs[old.id]
+        return job
+
+    async def run_job(
+        self,
+        job: Job,
+        files: Optional[List[Path]] = None,
+        recursive: Optional[bool] = None,
+        album_per_directory: Optional[bool] = None,
+        restricted: bool = False,
+    ) -> None:
+        options = self.client.options
+        recursive = options.get("recursive", False) if recursive is None else recursive
+        if album_per_directory is None:
+            album_per_directory = options.get("album_per_directory", False)
+        try:
+            folder_id, directory_ids = await self.client.find_albums(
+                job.path, job.folder, recursive, album_per_directory
+            )
+            paths = iter(files) if files is not None else walk_files(job.path, recursive=recursive)
+            if restricted:
+                paths = self.allowed_files(paths)
+            await self.client.upload_sources(paths, folder_id, directory_ids, functools.partial(self.save_result, job))
+        except asyncio.CancelledError:
+            job.finish("cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Job {job.id} for {job.path} failed")
+            job.finish("failed", repr(e))
+        else:
+            job.finish("done")
+
+    async def submit(self, request: web.Request) -> web.StreamResponse:
+        try:
+            data = await request.json()
+            path = Path(data["path"]).expanduser().resolve()
+        except (ValueError, KeyError, TypeError):
+            return web.json_response({"error": 'Expected JSON like {"path": "/some/file"}'}, status=400)
+        if not self.allowed(path):
+            return web.json_response({"error": f"{path} isn't in a directory the daemon may upload from"}, status=403)
+        if not path.exists():
+            return web.json_response({"error": f"{path} doesn't exist"}, status=400)
+        folder = data.get("folder") or (path.name if path.is_dir() else None)
+
+        job = self.new_job(path, folder)
+        results: asyncio.Queue = asyncio.Queue()
+        job.listeners.append(results)
+        task = asyncio.ensure_future(
+            self.run_job(
+                job,
+                recursive=data.get("recursive"),
+                album_per_directory=data.get("albumPerDirectory"),
+                restricted=True,
+            )
+        )
+        self._tasks.append(task)
+        task.add_done_callback(self._tasks.remove)
+        logger.info(f"Started job {job.id} for {path}")
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            while True:
+                message = await results.get()
+                await response.write(json.dumps(message).encode("utf-8") + b"\n")
+                if message["type"] == "done":
+                    break
+        except ConnectionResetError:
+            # The job keeps going without anyone listening
+            logger.info(f"Client of job {job.id} went away")
+        finally:
+            job.listeners.remove(results)
+        return response
+
+    async def list_jobs(self, request: web.Request) -> web.Response:
+        return web.json_response([x.summary() for x in self.jobs.values()])
+
+    async def get_job(self, request: web.Request) -> web.Response:
+        job = self.jobs.get(int(request.match_info["id"]))
+        if job is None:
+            return web.json_response({"error": "No such job"}, status=404)
+        return web.json_response(job.summary())
+
+    def watch(self, path: Path, folder: Optional[str] = None, settle: float = 10) -> None:
+        folder = folder or path.name
+        recursive = self.client.options.get("recursive", False)
+
+        async def on_ready(files: List[Path]) -> None:
+            job = self.new_job(path, folder)
+            await self.run_job(job, files, recursive)
+
+        watcher = DirectoryWatcher(path, on_ready, recursive=recursive, settle=settle)
+        self._tasks.append(asyncio.ensure_future(watcher.run()))
+
+    async def maintain(self) -> None:
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
+            try:
+                # Only refreshes in the background once the cached values are stale
+                await self.client.api.load_limits()
+                self.client.api.check_token()
+            except Exception:
+                logger.exception("Unable to refresh the server state")
+
+    async def serve(self) -> None:
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        if self.port is not None:
+            # Any local user can connect to the port so only those who can read the secret are let in
+            self.secret = create_secret(self.secret_path)
+            site = web.TCPSite(runner, self.host, self.port)
+            await site.start()
+            where = f"http://{self.host}:{self.port}"
+        else:
+            self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+            site = web.UnixSite(runner, str(self.socket_path))
+            # Only the user running the daemon may submit jobs, the socket is created that way instead of being
+            # restricted after it is already reachable
+            umask = os.umask(0o177)
+            try:
+                await site.start()
+            finally:
+                os.umask(umask)
+            os.chmod(self.socket_path, 0o600)
+            where = str(self.socket_path)
+        logger.info(f"Accepting upload jobs on {where}")
+
+        maintenance = asyncio.ensure_future(self.maintain())
+        try:
+            await asyncio.Event().wait()
+        finally:
+            maintenance.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(maintenance, *self._tasks, return_exceptions=True)
+            await runner.cleanup()
+            if self.results:
+                self.results.close()
+                logger.info(f"Saved {self.results.written} results to {self.results.path}")
+
+
+async def submit_job(
+    path: Path,
+    folder: Optional[str] = None,
+    socket_path: Optional[Path] = None,
+    host: str = "127.0.0.1",
+    port: Optional[int] = None,
+    recursive: Optional[bool] = None,
+    album_per_directory: Optional[bool] = None,
+    result_callback: Optional[Callable[[UploadResponse], Any]] = None,
+    secret_path: Optional[Path] = None,
+) -> int:
+    """Hands an upload to a running daemon and prints the results as they arrive, returning how many there were"""
+    headers = {}
+    if port is not None:
+        connector = None
+        url = f"http://{host}:{port}/jobs"
+        headers["Authorization"] = f"Bearer {secret_path.read_text().strip()}"
+    else:
+        connector = aiohttp.UnixConnector(path=str(socket_path))
+        url = "http://localhost/jobs"
+
+    data = {
+        "path": str(path.expanduser().resolve()),
+        "folder": folder,
+        "recursive": recursive,
+        "albumPerDirectory": album_per_directory,
+    }
+    count = 0
+    # Uploads can take any amount of time so only connecting has a timeout
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        async with session.post(url, json=data) as resp:
+            if resp.status != 200:
+                raise Exception(f"The daemon refused the job: {(await resp.json()).get('error')}")
+            async for line in resp.content:
+                message = json.loads(line)
+                if message["type"] == "result":
+                    response = message["response"]
+                    count += 1
+                    if result_callback:
+                        result_callback(response)
+                    uploaded = (response.get("files") or [{}])[0]
+                    print(f"{uploaded.get('uploadSuccess')}\t{uploaded.get('url')}\t{uploaded.get('filePath')}")
+                else:
+                    print(
+                        f"Job {message['id']} {message['status']}: {message['uploaded']} uploaded, {message['failed']} failed"
+                    )
+                    if message.get("error"):
+                        raise Exception(f"Job {message['id']} failed: {message['error']}")
+    return count
@@ -0,0 +1,208 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+HASH_READ_SIZE = 1024 * 1024
+# Most bytes of blocks a file's hasher keeps while they wait for the blocks before them, a few of the 256KiB blocks
+# uploads are read in so memory stays at a small fixed amount per upload like the read buffers
+PENDING_LIMIT = 4 * 256 * 1024
+
+
+def md5_file(file: Path, offset: int = 0, length: Optional[int] = None) -> str:
+    """Reads the whole file or `length` bytes from `offset`, this blocks so it should be run in an executor"""
+    md5 = hashlib.md5()
+    with open(file, "rb") as f:
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            data = f.read(HASH_READ_SIZE if remaining is None else min(HASH_READ_SIZE, remaining))
+            if not data:
+                break
+            md5.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return md5.hexdigest()
+
+
+def new_hash(name: str):
+    """Any hashlib algorithm or one from the optional xxhash package such as xxh3_64"""
+    try:
+        return hashlib.new(name)
+    except ValueError:
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError(f"Unknown hash algorithm {name}, install xxhash for the xxh algorithms")
+        if not hasattr(xxhash, name):
+            raise ValueError(f"Unknown hash algorithm {name}")
+        return getattr(xxhash, name)()
+
+
+class StreamHasher:
+    """
+    Hashes a file from the blocks that are read to upload it so it never has to be read again just to be hashed.
+
+    Blocks can arrive out of order and more than once because chunks are sent in parallel and retried. Blocks from
+    before the hashed position are ignored and blocks from further along are copied and kept until the blocks before
+    them arrive, up to `pending_limit` bytes. Ranges that didn't fit, such as most of the other chunks when several
+    chunks of a file are sent at once, or were never read, such as the chunks of a resumed upload, are read from the
+    file again by `hexdigests()`. `offset` is where the hashed range starts in the file.
+    """
+
+    def __init__(
+        self,
+        file: Path,
+        size: int,
+        algorithms: Optional[list] = None,
+        offset: int = 0,
+        pending_limit: int = PENDING_LIMIT,
+    ):
+        self.file = file
+        self.size = size
+        self.offset = offset
+        self.hashes = {name: new_hash(name) for name in ["md5"] + (algorithms or [])}
+        self.position = 0
+        self.pending: Dict[int, bytes] = {}
+        self.pending_size = 0
+        self.pending_limit = pending_limit
+        # Bytes that had to be read from the file again to hash them
+        self.reread = 0
+        self._lock = threading.Lock()
+
+    def _update(self, data) -> None:
+        for file_hash in self.hashes.values():
+            file_hash.update(data)
+        self.position += len(data)
+
+    def _drain(self) -> None:
+        """Hashes the kept blocks that the hashed position has reached"""
+        while self.pending:
+            offset = min(self.pending)
+            if offset > self.position:
+                return
+            data = self.pending.pop(offset)
+            self.pending_size -= len(data)
+            if offset + len(data) > self.position:
+                self._update(memoryview(data)[self.position - offset :])
+
+    def _catch_up(self, offset: int) -> None:
+        with open(self.file, "rb") as f:
+            f.seek(self.offset + self.position)
+            while self.position < offset:
+                data = f.read(min(HASH_READ_SIZE, offset - self.position))
+                if not data:
+                    raise EOFError(f"{self.file} was shorter than expected while hashing it")
+                self.reread += len(data)
+                self._update(data)
+
+    def update(self, offset: int, data) -> None:
+        """Feeds a block read from `offset`, called from the reader threads so it never touches the disk"""
+        with self._lock:
+            offset -= self.offset
+            if offset + len(data) <= self.position:
+                return
+            if offset > self.position:
+                if offset not in self.pending and self.pending_size + len(data) <= self.pending_limit:
+                    self.pending[offset] = bytes(data)
+                    self.pending_size += len(data)
+                return
+            self._update(memoryview(data)[self.position - offset :])
+            self._drain()
+
+    def hexdigests(self) -> Dict[str, str]:
+        """Hashes whatever wasn't seen yet, this blocks so it should be run in an executor, and returns every digest"""
+        with self._lock:
+            while self.position < self.size:
+                self._catch_up(min(min(self.pending, default=self.size), self.size))
+                self._drain()
+            return {name: file_hash.hexdigest() for name, file_hash in self.hashes.items()}
+
+
+class HashIndex:
+    """
+    Caches the MD5 digest of local files and remembers which digests were uploaded to which album.
+
+    Digests are keyed by device, inode, size and modification time so an unchanged file is never hashed twice.
+    Anonymous uploads are stored under an empty album id.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(str(path), isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS digests (
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                md5 TEXT NOT NULL,
+                PRIMARY KEY (device, inode)
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS uploads (
+                md5 TEXT NOT NULL,
+                album_id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                file_name TEXT,
+                url TEXT,
+                uploaded REAL NOT NULL,
+                PRIMARY KEY (md5, album_id)
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS uploads_size ON uploads (album_id, size)")
+
+    def cached_digest(self, file: Path) -> Optional[str]:
+        stat = os.stat(file)
+        row = self.db.execute(
+            "SELECT md5 FROM digests WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        return row[0] if row else None
+
+    def store_digest(self, file: Path, md5: str) -> None:
+        stat = os.stat(file)
+        self.db.execute(
+            "INSERT OR REPLACE INTO digests (device, inode, size, mtime_ns, md5) VALUES (?, ?, ?, ?, ?)",
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, md5),
+        )
+
+    def has_size(self, album_id: Optional[str], size: int) -> bool:
+        """A file can only be a duplicate if something of the same size was already uploaded to the album"""
+        row = self.db.execute(
+            "SELECT 1 FROM uploads WHERE album_id = ? AND size = ? LIMIT 1", (album_id or "", size)
+        ).fetchone()
+        return row is not None
+
+    def find_upload(self, md5: str, album_id: Optional[str]) -> Optional[dict]:
+        row = self.db.execute(
+            "SELECT file_name, url, uploaded FROM uploads WHERE md5 = ? AND album_id = ?", (md5, album_id or "")
+        ).fetchone()
+        if row is None:
+            return None
+        return {"fileName": row[0], "url": row[1], "uploaded": row[2]}
+
+    def record_upload(self, md5: str, album_id: Optional[str], size: int, file_name: str, url: Optional[str]) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO uploads (md5, album_id, size, file_name, url, uploaded) VALUES (?, ?, ?, ?, ?, ?)",
+            (md5, album_id or "", size, file_name, url, time.time()),
+        )
+
+    def import_uploads(self, uploads: Iterable[Tuple[str, Optional[str], int, str, Optional[str]]]) -> None:
+        """Adds uploads known from elsewhere, such as saved results, keeping what is already recorded"""
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO uploads (md5, album_id, size, file_name, url, uploaded) VALUES (?, ?, ?, ?, ?, ?)",
+                ((md5, album_id or "", size, name, url, time.time()) for md5, album_id, size, name, url in uploads),
+            )
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,84 @@
+import collections
+import logging
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkDeadlines:
+    """
+    Works out how long a chunk may take before a duplicate of it is sent and before it is given up on.
+
+    Every acknowledged chunk records the seconds per byte it took on its node. Once a node has `min_samples` of them a
+    chunk still running past the `percentile` of those times, scaled to its length, gets a hedged copy sent alongside
+    it and whichever is acknowledged first wins. At most `max_hedges` copies are in flight at once so a node that is
+    slow for everyone doesn't get twice the load. A chunk is given up on after `slack` times what the node's median
+    says it should take, never sooner than `min_deadline` and never later than `max_deadline`, which follows the
+    server's chunk timeout.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        min_samples: int = 8,
+        window: int = 64,
+        slack: float = 4.0,
+        min_deadline: float = 30,
+        max_deadline: float = 600,
+        max_hedges: int = 2,
+        min_hedge_delay: float = 1.0,
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.slack = slack
+        self.min_deadline = min_deadline
+        self.max_deadline = max(max_deadline, min_deadline)
+        self.max_hedges = max_hedges
+        # Chunks that fast aren't worth a second copy however they compare to the others
+        self.min_hedge_delay = min_hedge_delay
+        self.hedges = 0
+        self.samples: Dict[str, Deque[float]] = {}
+
+    def set_max_deadline(self, seconds: float) -> None:
+        self.max_deadline = max(seconds, self.min_deadline)
+
+    def record(self, server: str, length: int, seconds: float) -> None:
+        if length <= 0 or seconds <= 0:
+            return
+        if server not in self.samples:
+            self.samples[server] = collections.deque(maxlen=self.window)
+        self.samples[server].append(seconds / length)
+
+    def _quantile(self, server: str, q: float) -> Optional[float]:
+        samples = self.samples.get(server)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * q / 100), len(ordered) - 1)]
+
+    def deadline(self, server: str, length: int) -> float:
+        """Seconds a single send of this chunk may take before it counts as failed"""
+        median = self._quantile(server, 50)
+        if median is None:
+            return self.max_deadline
+        return min(max(median * length * self.slack, self.min_deadline), self.max_deadline)
+
+    def hedge_after(self, server: str, length: int) -> Optional[float]:
+        """Seconds after which a copy of this chunk should be sent, None until enough chunks were measured"""
+        if not self.percentile or not self.max_hedges:
+            return None
+        slow = self._quantile(server, self.percentile)
+        if slow is None:
+            return None
+        seconds = max(slow * length, self.min_hedge_delay)
+        return seconds if seconds < self.deadline(server, length) else None
+
+    def start_hedge(self) -> bool:
+        if self.hedges >= self.max_hedges:
+            return False
+        self.hedges += 1
+        return True
+
+    def finish_hedge(self) -> None:
+        self.hedges -= 1
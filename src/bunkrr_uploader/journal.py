@@ -0,0 +1,115 @@
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from pathlib import Path
+from typing import Optional, Set, Tuple
+
+from .split import FilePart, UploadSource, source_range
+
+logger = logging.getLogger(__name__)
+
+
+def file_identity(file: UploadSource) -> str:
+    """Identifies a file by where it lives on disk and its last modification so edited files are never resumed"""
+    path, offset = source_range(file)
+    stat = os.stat(path)
+    identity = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+    if isinstance(file, FilePart):
+        identity += f":{offset}:{file.size}"
+    return identity
+
+
+class UploadJournal:
+    """
+    Keeps track of the chunks the server acknowledged for every chunked upload in an SQLite database.
+
+    A file that failed part way through, either in this run or a previous one, continues with the same dzuuid on the
+    same server from the chunks that are still missing.
+    """
+
+    def __init__(self, path: Path, max_age: Optional[float] = None):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        # Servers throw away unfinished chunks after a while so older uploads can't be resumed
+        self.max_age = max_age
+        self.db = sqlite3.connect(str(path), isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS uploads (
+                file_key TEXT PRIMARY KEY,
+                file_path TEXT NOT NULL,
+                dzuuid TEXT NOT NULL UNIQUE,
+                server TEXT NOT NULL,
+                chunk_size INTEGER NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS chunks (
+                dzuuid TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                PRIMARY KEY (dzuuid, chunk_index)
+            )"""
+        )
+
+    def find(self, file: UploadSource) -> Optional[Tuple[str, str, int]]:
+        """Returns the dzuuid, server and chunk size of an unfinished upload of this file if it can still be resumed"""
+        row = self.db.execute(
+            "SELECT dzuuid, server, chunk_size, updated FROM uploads WHERE file_key = ?", (file_identity(file),)
+        ).fetchone()
+        if row is None:
+            return None
+        file_uuid, server, chunk_size, updated = row
+        if self.max_age is not None and time.time() - updated > self.max_age:
+            logger.debug(f"Unfinished upload {file_uuid} of {file} is too old to resume")
+            self.finish(file_uuid)
+            return None
+        return file_uuid, server, chunk_size
+
+    def start(self, file: UploadSource, server: str, chunk_size: int) -> Tuple[str, Set[int], int]:
+        """
+        Returns the dzuuid and chunk size to use for the file and the chunk indexes that were already acknowledged.
+
+        An unfinished upload to the same server keeps the chunk size it was started with.
+        """
+        existing = self.find(file)
+        if existing:
+            file_uuid, existing_server, existing_chunk_size = existing
+            if existing_server == server:
+                return file_uuid, self.acknowledged(file_uuid), existing_chunk_size
+            self.finish(file_uuid)
+
+        file_uuid = str(uuid.uuid4())
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM uploads WHERE file_key = ?", (file_identity(file),))
+            self.db.execute(
+                "INSERT INTO uploads (file_key, file_path, dzuuid, server, chunk_size, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (file_identity(file), str(file), file_uuid, server, chunk_size, time.time()),
+            )
+        return file_uuid, set(), chunk_size
+
+    def acknowledged(self, file_uuid: str) -> Set[int]:
+        rows = self.db.execute("SELECT chunk_index FROM chunks WHERE dzuuid = ?", (file_uuid,))
+        return {x[0] for x in rows}
+
+    def ack(self, file_uuid: str, chunk_index: int) -> None:
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(
+                "INSERT OR IGNORE INTO chunks (dzuuid, chunk_index) VALUES (?, ?)", (file_uuid, chunk_index)
+            )
+            self.db.execute("UPDATE uploads SET updated = ? WHERE dzuuid = ?", (time.time(), file_uuid))
+
+    def finish(self, file_uuid: str) -> None:
+        """Forgets an upload once it was completed or can't be resumed anymore"""
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM chunks WHERE dzuuid = ?", (file_uuid,))
+            self.db.execute("DELETE FROM uploads WHERE dzuuid = ?", (file_uuid,))
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,460 @@
+import argparse
+import asyncio
+import functools
+import hashlib
+import itertools
+import logging
+import os
+import random
+import socket
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from .state import parse_size
+
+logger = logging.getLogger(__name__)
+
+# How much of a request body is read at once, bandwidth is accounted for at this granularity
+READ_SIZE = 64 * 1024
+# Ways an upload request can be made to fail
+FAILURE_MODES = ["error", "throttle", "refuse", "reset", "stall"]
+
+
+class Throttle:
+    """Spreads the bytes of every request to a node over time so together they don't go faster than `rate`"""
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate
+        self.next = time.monotonic()
+
+    async def consume(self, size: int) -> None:
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.next = max(self.next, now) + size / self.rate
+        if self.next - now > 0.001:
+            await asyncio.sleep(self.next - now)
+
+
+class MockNode:
+    """An upload node with its own bandwidth, latency and share of requests that fail"""
+
+    def __init__(
+        self,
+        bandwidth: Optional[float] = None,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        failure_modes: Optional[List[str]] = None,
+        stall: float = 30.0,
+    ):
+        self.throttle = Throttle(bandwidth)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_modes = failure_modes or ["error", "throttle", "refuse", "reset"]
+        self.stall = stall
+        self.url = ""
+
+
+class ChunkedUpload:
+    def __init__(self, total_size: int, chunk_count: int, chunk_size: int, path: Optional[Path]):
+        self.total_size = total_size
+        self.chunk_count = chunk_count
+        self.chunk_size = chunk_size
+        # Offset and length of every chunk that arrived
+        self.chunks: Dict[int, Tuple[int, int]] = {}
+        self.path = path
+        self.updated = time.monotonic()
+
+
+class MockBunkrr:
+    """
+    Stands in for the Bunkrr API and its upload nodes to measure and test uploads without touching the real service.
+
+    Implements /api/check, /api/node, /api/albums, /api/tokens/verify, /api/upload, both single requests and Dropzone
+    chunks, and /api/upload/finishchunks. Every node listens on a port of its own. Chunks are checked when they are
+    put together: every chunk has to be there, at the offset its index says and adding up to the file size. With
+    `verify` the data is kept in temporary files so the MD5 of every upload can be compared with the local files.
+
+    GET /mock/stats returns what was uploaded along with request counts and latencies, POST /mock/reset forgets it.
+    """
+
+    def __init__(
+        self,
+        nodes: Optional[List[MockNode]] = None,
+        max_size: str = "2GB",
+        chunk_size: str = "25MB",
+        max_chunk_size: str = "95MB",
+        chunk_timeout: int = 30 * 60 * 1000,
+        verify: bool = True,
+        seed: Optional[int] = None,
+    ):
+        self.nodes = nodes or [MockNode()]
+        self.check = {
+            "private": True,
+            "enableUserAccounts": True,
+            "maxSize": max_size,
+            "chunkSize": {"max": max_chunk_size, "default": chunk_size, "timeout": chunk_timeout},
+            "fileIdentifierLength": {"min": 4, "max": 32, "default": 8, "force": False},
+            "stripTags": {"default": False, "video": False, "force": False, "blacklistExtensions": [".exe", ".bat"]},
+            "temporaryUploadAges": [],
+            "defaultTemporaryUploadAge": 0,
+        }
+        self.max_size = parse_size(max_size)
+        self.chunk_timeout = chunk_timeout / 1000
+        self.verify = verify
+        self.random = random.Random(seed)
+        self.temporary_dir: Optional[tempfile.TemporaryDirectory] = None
+        self.runners: List[web.AppRunner] = []
+        self.url = ""
+        self._next_node = itertools.cycle(range(len(self.nodes)))
+        self._album_ids = itertools.count(1)
+        self.albums: List[Dict[str, Any]] = []
+        self.reset()
+
+    def reset(self) -> None:
+        self.chunked: Dict[str, ChunkedUpload] = {}
+        self.uploads: List[Dict[str, Any]] = []
+        self.requests = 0
+        self.chunk_requests = 0
+        self.chunk_latencies: List[float] = []
+        self.failures = 0
+        self.reassembly_errors = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "uploads": self.uploads,
+            "requests": self.requests,
+            "chunkRequests": self.chunk_requests,
+            "chunkLatencies": self.chunk_latencies,
+            "failuresInjected": self.failures,
+            "reassemblyErrors": self.reassembly_errors,
+            "albums": len(self.albums),
+        }
+
+    def api_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/check", self.handle_check)
+        app.router.add_get("/api/node", self.handle_node)
+        app.router.add_post("/api/tokens/verify", self.handle_verify)
+        app.router.add_get("/api/albums", self.handle_albums)
+        app.router.add_post("/api/albums", self.handle_create_album)
+        app.router.add_get("/mock/stats", self.handle_stats)
+        app.router.add_post("/mock/reset", self.handle_reset)
+        return app
+
+    def node_app(self, node: MockNode) -> web.Application:
+        app = web.Application(client_max_size=self.max_size * 2)
+        app.router.add_post("/api/upload", functools.partial(self.handle_upload, node=node))
+        app.router.add_post("/api/upload/finishchunks", functools.partial(self.handle_finish, node=node))
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        if self.verify:
+            self.temporary_dir = tempfile.TemporaryDirectory(prefix="bunkrr-mock-")
+        for node in self.nodes:
+            node.url = await self._serve(self.node_app(node), host, 0)
+        self.url = await self._serve(self.api_app(), host, port)
+        logger.info(f"Mock Bunkrr API on {self.url} with nodes {', '.join(x.url for x in self.nodes)}")
+        return self.url
+
+    async def _serve(self, app: web.Application, host: str, port: int) -> str:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        # The socket is bound here so the port is known even when any free one was asked for
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        site = web.SockSite(runner, sock)
+        await site.start()
+        self.runners.append(runner)
+        bound_host, bound_port = sock.getsockname()[:2]
+        return f"http://{bound_host}:{bound_port}"
+
+    async def stop(self) -> None:
+        for runner in self.runners:
+            await runner.cleanup()
+        self.runners = []
+        if self.temporary_dir:
+            self.temporary_dir.cleanup()
+            self.temporary_dir = None
+
+    async def handle_check(self, request: web.Request) -> web.Response:
+        return web.json_response(self.check)
+
+    async def handle_node(self, request: web.Request) -> web.Response:
+        node = self.nodes[next(self._next_node)]
+        return web.json_response({"success": True, "url": f"{node.url}/api/upload"})
+
+    async def handle_verify(self, request: web.Request) -> web.Response:
+        return web.json_response({"success": True, "username": "mock", "group": "user"})
+
+    async def handle_albums(self, request: web.Request) -> web.Response:
+        page = max(int(request.query.get("page", 1)), 1)
+        newest_first = self.albums[::-1]
+        return web.json_response(
+            {"success": True, "albums": newest_first[(page - 1) * 50 : page * 50], "count": len(self.albums)}
+        )
+
+    async def handle_create_album(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        album = {"id": next(self._album_ids), "name": data["name"], "identifier": os.urandom(4).hex()}
+        self.albums.append(album)
+        return web.json_response({"success": True, "id": album["id"]})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({"success": True})
+
+    async def inject_failure(self, request: web.Request, node: MockNode) -> Optional[web.StreamResponse]:
+        """Returns the response of a failed request every so often, or None to handle it normally"""
+        if self.random.random() >= node.failure_rate:
+            return None
+        self.failures += 1
+        mode = self.random.choice(node.failure_modes)
+        if mode == "throttle":
+            return web.json_response(
+                {"success": False, "description": "Slow down"}, status=429, headers={"Retry-After": "1"}
+            )
+        if mode == "refuse":
+            return web.json_response({"success": False, "description": "Could not process the upload"})
+        if mode == "reset":
+            request.transport.close()
+            return web.Response(status=500)
+        if mode == "stall":
+            await asyncio.sleep(node.stall)
+        return web.Response(status=503, text="<html><body>503 Service Unavailable</body></html>")
+
+    async def handle_upload(self, request: web.Request, node: MockNode) -> web.StreamResponse:
+        self.requests += 1
+        started = time.monotonic()
+        await asyncio.sleep(node.latency)
+        failed = await self.inject_failure(request, node)
+        if failed is not None:
+            return failed
+
+        fields: Dict[str, str] = {}
+        files = []
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name != "files[]":
+                fields[part.name] = await part.text()
+                continue
+            upload = self.chunked_upload(fields) if "dzuuid" in fields else None
+            if "dzuuid" in fields and upload is None:
+                return web.json_response({"success": False, "description": "Invalid chunk"}, status=400)
+            md5 = hashlib.md5()
+            size = 0
+            offset = int(fields.get("dzchunkbyteoffset", 0))
+            handle = open(upload.path, "r+b") if upload and upload.path else None
+            try:
+                while True:
+                    data = await part.read_chunk(READ_SIZE)
+                    if not data:
+                        break
+                    await node.throttle.consume(len(data))
+                    if handle:
+                        handle.seek(offset + size)
+                        handle.write(data)
+                    elif self.verify and not upload:
+                        md5.update(data)
+                    size += len(data)
+            finally:
+                if handle:
+                    handle.close()
+            if upload:
+                upload.chunks[int(fields["dzchunkindex"])] = (offset, size)
+                upload.updated = time.monotonic()
+            else:
+                files.append((part.filename, size, md5.hexdigest() if self.verify else None))
+
+        if "dzuuid" in fields:
+            self.chunk_requests += 1
+            self.chunk_latencies.append(time.monotonic() - started)
+            return web.json_response({"success": True})
+        if not files:
+            return web.json_response({"success": False, "description": "No files"}, status=400)
+        if any(x[1] > self.max_size for x in files):
+            return web.json_response({"success": False, "description": "File too large"}, status=400)
+        return web.json_response({"success": True, "files": [self.add_upload(*x, fields) for x in files]})
+
+    def chunked_upload(self, fields: Dict[str, str]) -> Optional[ChunkedUpload]:
+        try:
+            file_uuid = fields["dzuuid"]
+            total_size = int(fields["dztotalfilesize"])
+            chunk_count = int(fields["dztotalchunkcount"])
+            chunk_size = int(fields["dzchunksize"])
+        except (KeyError, ValueError):
+            return None
+        upload = self.chunked.get(file_uuid)
+        if upload and time.monotonic() - upload.updated > self.chunk_timeout:
+            # The real server throws away chunks that weren't finished in time
+            self.drop(file_uuid)
+            upload = None
+        if upload is None:
+            path = None
+            if self.verify:
+                path = Path(self.temporary_dir.name) / file_uuid
+                path.touch()
+            upload = self.chunked[file_uuid] = ChunkedUpload(total_size, chunk_count, chunk_size, path)
+        if (upload.total_size, upload.chunk_count, upload.chunk_size) != (total_size, chunk_count, chunk_size):
+            return None
+        return upload
+
+    def drop(self, file_uuid: str) -> None:
+        upload = self.chunked.pop(file_uuid, None)
+        if upload and upload.path:
+            upload.path.unlink()
+
+    def reassembly_error(self, upload: ChunkedUpload) -> Optional[str]:
+        missing = [x for x in range(upload.chunk_count) if x not in upload.chunks]
+        if missing:
+            return f"Missing chunks {missing[:10]}"
+        for index, (offset, size) in upload.chunks.items():
+            if offset != index * upload.chunk_size:
+                return f"Chunk {index} was sent at offset {offset} instead of {index * upload.chunk_size}"
+            if size != min(upload.chunk_size, upload.total_size - offset):
+                return f"Chunk {index} has {size} bytes"
+        if sum(x[1] for x in upload.chunks.values()) != upload.total_size:
+            return "Chunks don't add up to the file size"
+        return None
+
+    async def handle_finish(self, request: web.Request, node: MockNode) -> web.StreamResponse:
+        self.requests += 1
+        await asyncio.sleep(node.latency)
+        failed = await self.inject_failure(request, node)
+        if failed is not None:
+            return failed
+
+        data = await request.json()
+        responses = []
+        for entry in data.get("files", []):
+            upload = self.chunked.get(entry.get("uuid"))
+            if upload is None:
+                return web.json_response({"success": False, "description": "Could not find the chunks"}, status=400)
+            error = self.reassembly_error(upload)
+            if error:
+                self.reassembly_errors += 1
+                self.drop(entry["uuid"])
+                return web.json_response({"success": False, "description": error}, status=400)
+            md5 = None
+            if upload.path:
+                loop = asyncio.get_running_loop()
+                md5 = await loop.run_in_executor(None, md5_path, upload.path)
+            self.drop(entry["uuid"])
+            responses.append(self.add_upload(entry.get("original", ""), upload.total_size, md5, entry))
+        return web.json_response({"success": True, "files": responses})
+
+    def add_upload(self, name: str, size: int, md5: Optional[str], fields: Dict[str, Any]) -> Dict[str, Any]:
+        identifier = os.urandom(6).hex()
+        self.uploads.append({"name": name, "size": size, "md5": md5, "albumid": fields.get("albumid") or None})
+        uploaded = {"name": f"{identifier}-{name}", "url": f"{self.url}/f/{identifier}", "original": name}
+        if md5:
+            uploaded["md5"] = md5
+        return uploaded
+
+
+def md5_path(path: Path) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while data := f.read(1024 * 1024):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def parse_node(spec: str, defaults: Dict[str, Any]) -> MockNode:
+    """Reads a node like `bandwidth=10MB,latency=0.05,failures=0.1,modes=error+reset`"""
+    values = dict(defaults)
+    for item in filter(None, spec.split(",")):
+        key, _, value = item.partition("=")
+        values[key.strip()] = value.strip()
+    modes = values.get("modes")
+    if isinstance(modes, str):
+        modes = modes.split("+")
+    unknown = set(modes or []) - set(FAILURE_MODES)
+    if unknown:
+        raise ValueError(f"Unknown failure modes {', '.join(unknown)}, use {', '.join(FAILURE_MODES)}")
+    bandwidth = values.get("bandwidth")
+    return MockNode(
+        bandwidth=parse_size(bandwidth) if isinstance(bandwidth, str) else bandwidth,
+        latency=float(values.get("latency") or 0),
+        failure_rate=float(values.get("failures") or 0),
+        failure_modes=modes,
+        stall=float(values.get("stall") or 30),
+    )
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--nodes", type=int, default=2, help="Upload nodes to run when no --node is given")
+    parser.add_argument(
+        "--node",
+        action="append",
+        default=[],
+        help="An upload node such as bandwidth=10MB,latency=0.05,failures=0.1,modes=error+reset, can be given several "
+        "times. Values that are left out come from the flags below",
+    )
+    parser.add_argument("--bandwidth", help="Bytes per second each node receives, such as 20MB, unlimited by default")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every upload request is delayed by")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of upload requests that fail")
+    parser.add_argument(
+        "--failure-modes",
+        default="error+throttle+refuse+reset",
+        help=f"How requests fail, any of {', '.join(FAILURE_MODES)} joined with +",
+    )
+    parser.add_argument("--max-size", default="2GB", help="Max file size the server accepts")
+    parser.add_argument("--chunk-size", default="25MB", help="Default chunk size")
+    parser.add_argument("--max-chunk-size", default="95MB", help="Max chunk size")
+    parser.add_argument(
+        "--no-verify", action="store_true", help="Don't keep uploaded data to check its MD5, saves disk space"
+    )
+    parser.add_argument("--failure-seed", type=int, help="Seed for failure injection to make runs repeatable")
+
+
+def mock_from_args(args: argparse.Namespace) -> MockBunkrr:
+    defaults = {
+        "bandwidth": args.bandwidth,
+        "latency": args.latency,
+        "failures": args.failure_rate,
+        "modes": args.failure_modes,
+    }
+    nodes = [parse_node(x, defaults) for x in args.node] or [parse_node("", defaults) for _ in range(args.nodes)]
+    return MockBunkrr(
+        nodes,
+        max_size=args.max_size,
+        chunk_size=args.chunk_size,
+        max_chunk_size=args.max_chunk_size,
+        verify=not args.no_verify,
+        seed=args.failure_seed,
+    )
+
+
+async def serve(args: argparse.Namespace) -> None:
+    mock = mock_from_args(args)
+    url = await mock.start(args.host, args.port)
+    print(f"Upload with: bunkrr-upload --api-url {url} <file>")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await mock.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for the Bunkrr API to test and benchmark uploads")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
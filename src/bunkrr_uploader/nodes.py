@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+from pprint import pformat
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .types import NodeResponse
+
+logger = logging.getLogger(__name__)
+
+
+class NodeStats:
+    """What we've measured about uploading to a single node"""
+
+    # How much weight new measurements get in the moving averages
+    smoothing = 0.3
+
+    def __init__(self, server: str):
+        self.server = server
+        self.discovered = time.monotonic()
+        self.active = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self.disabled_until = 0.0
+        # Times in a row the node was left alone, after which a single request decides whether it is used again
+        self.trips = 0
+
+    def _average(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return current + self.smoothing * (value - current)
+
+    @property
+    def error_rate(self) -> float:
+        return self.failures / self.requests if self.requests else 0.0
+
+    def healthy(self, now: float) -> bool:
+        if now < self.disabled_until:
+            return False
+        # Only one request at a time probes a node that just came back
+        return not (self.trips and self.active)
+
+    def record_success(self, size: int, seconds: float) -> None:
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.latency = self._average(self.latency, seconds)
+        if seconds > 0:
+            self.throughput = self._average(self.throughput, size / seconds)
+
+    def record_failure(self) -> None:
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+
+    def __repr__(self) -> str:
+        return (
+            f"<NodeStats {self.server} active={self.active} requests={self.requests} error_rate={self.error_rate:.2f} "
+            f"latency={self.latency} throughput={self.throughput}>"
+        )
+
+
+class NodePool:
+    """
+    Caches the upload nodes handed out by /api/node and spreads uploads across the healthy ones.
+
+    Nodes are asked for again once the cache is older than `ttl`. Every upload request reports back how it went so
+    new work goes to the node with the most throughput per active upload, and a node that fails `max_failures` times
+    in a row is left alone for `cooldown` seconds. After that a single request is let through and if it fails too the
+    node is left alone again for twice as long, up to `max_cooldown`.
+
+    When every node is left alone there is nothing to move uploads to, so they wait for the first node to come back for
+    at most `fallback_wait` seconds and then use the node that comes back soonest until one is healthy again.
+    """
+
+    def __init__(
+        self,
+        get_node: Callable[[], Awaitable[NodeResponse]],
+        ttl: float = 600,
+        discover: int = 3,
+        max_failures: int = 3,
+        cooldown: float = 300,
+        max_cooldown: float = 3600,
+        fallback_wait: float = 30,
+    ):
+        self.get_node = get_node
+        self.ttl = ttl
+        # How many times /api/node is asked for a node when refreshing since it only returns one at a time
+        self.discover = discover
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.fallback_wait = fallback_wait
+        # When uploads stop waiting for a node while every node is left alone
+        self.fallback_at: Optional[float] = None
+        self.nodes: Dict[str, NodeStats] = {}
+        self.refreshed = 0.0
+        self._refresh_lock = asyncio.Lock()
+
+    async def _fetch(self) -> Optional[str]:
+        try:
+            node_response = await self.get_node()
+        except Exception as e:
+            logger.error(f"Failed to get server to upload to: {e!r}")
+            return None
+        if not node_response.get("success"):
+            logger.error(f"Failed to get server to upload to: {pformat(node_response)}")
+            return None
+        return "/".join(node_response["url"].split("/")[:3])
+
+    async def refresh(self) -> None:
+        async with self._refresh_lock:
+            # Another upload may have refreshed the cache while this one waited for the lock
+            if self.healthy_nodes() and time.monotonic() - self.refreshed < self.ttl:
+                return
+            servers = await asyncio.gather(*[self._fetch() for _ in range(self.discover)])
+            now = time.monotonic()
+            for server in filter(None, servers):
+                if server not in self.nodes:
+                    logger.info(f"Discovered upload node {server}")
+                    self.nodes[server] = NodeStats(server)
+                self.nodes[server].discovered = now
+            # Nodes the API stopped handing out are forgotten unless they are still being used
+            for server in list(self.nodes):
+                stats = self.nodes[server]
+                if now - stats.discovered > self.ttl * 2 and stats.active == 0:
+                    del self.nodes[server]
+            if any(servers):
+                self.refreshed = now
+
+    def healthy_nodes(self) -> List[NodeStats]:
+        now = time.monotonic()
+        return [x for x in self.nodes.values() if x.healthy(now)]
+
+    def is_healthy(self, server: str) -> bool:
+        stats = self.nodes.get(server)
+        return stats is None or stats.healthy(time.monotonic())
+
+    def available_in(self) -> Optional[float]:
+        """Seconds until get_server returns a node again, None when no node is known at all"""
+        if not self.nodes:
+            return None
+        return max((self.fallback_at or 0.0) - time.monotonic(), 0.0)
+
+    async def get_server(self, fallback: bool = False) -> Optional[str]:
+        """
+        Returns the node new work should go to, or None while every node is left alone and uploads still wait for one.
+        With `fallback` a node is returned without waiting as long as any is known.
+        """
+        if not self.healthy_nodes() or time.monotonic() - self.refreshed > self.ttl:
+            await self.refresh()
+        nodes = self.healthy_nodes()
+        if not nodes:
+            if not self.nodes:
+                return None
+            now = time.monotonic()
+            soonest = min(self.nodes.values(), key=lambda x: (x.disabled_until, x.consecutive_failures))
+            if self.fallback_at is None:
+                self.fallback_at = now + min(max(soonest.disabled_until - now, 0.0), self.fallback_wait)
+            return soonest.server if fallback or now >= self.fallback_at else None
+        self.fallback_at = None
+
+        # Nodes without measurements yet are assumed to be as fast as the best one so they get tried
+        known = [x.throughput for x in nodes if x.throughput]
+        best = max(known) if known else 1.0
+        chosen = max(nodes, key=lambda x: (x.throughput or best) * (1 - x.error_rate) / (x.active + 1))
+        return chosen.server
+
+    def _stats(self, server: str) -> NodeStats:
+        if server not in self.nodes:
+            self.nodes[server] = NodeStats(server)
+        return self.nodes[server]
+
+    def start(self, server: str) -> float:
+        self._stats(server).active += 1
+        return time.monotonic()
+
+    def cancel(self, server: str) -> None:
+        """For a request that was dropped because another one did its job, it says nothing about the node"""
+        self._stats(server).active -= 1
+
+    def finish(self, server: str, started: float, success: bool, size: int = 0) -> None:
+        stats = self._stats(server)
+        stats.active -= 1
+        if success:
+            stats.record_success(size, time.monotonic() - started)
+            return
+
+        stats.record_failure()
+        # Requests that were already running when the node was left alone don't make it any worse
+        if time.monotonic() < stats.disabled_until:
+            return
+        if stats.consecutive_failures >= self.max_failures or stats.trips:
+            cooldown = min(self.cooldown * 2**stats.trips, self.max_cooldown)
+            logger.warning(f"Not using {server} for {cooldown:.0f}s after {stats.consecutive_failures} failures")
+            stats.disabled_until = time.monotonic() + cooldown
+            stats.consecutive_failures = 0
+            stats.trips += 1
@@ -0,0 +1,117 @@
+import collections
+import os
+import time
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Deque, Optional, Tuple
+
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.payload import Payload
+
+from .hashindex import StreamHasher
+from .reader import BufferPool, ReadAheadReader
+
+# How much of the file gets read and handed to the socket at once. This has to stay above the transport's high water
+# mark so that draining after a write means every block but the last one has been flushed.
+BLOCK_SIZE = 256 * 1024
+
+
+class FileRangePayload(Payload):
+    """
+    Streams `length` bytes of a file starting at `offset` straight to the socket.
+
+    Blocks are read ahead in a thread pool into buffers from a shared BufferPool so the event loop never waits on the
+    disk and memory per connection stays at `read_ahead` blocks no matter how big the chunk is. Every block waits for
+    `throttle` before it is sent when bandwidth is limited. The payload can be written more than once which lets retries
+    reuse it.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        offset: int = 0,
+        length: Optional[int] = None,
+        pool: Optional[BufferPool] = None,
+        executor: Optional[Executor] = None,
+        read_ahead: int = 2,
+        hasher: Optional[StreamHasher] = None,
+        throttle: Optional[Callable[[int], Awaitable[None]]] = None,
+        *args: Any,
+        **kwargs: Any,
+    ):
+        if length is None:
+            length = os.stat(path).st_size - offset
+        super().__init__(path, *args, **kwargs)
+        self._path = path
+        self._offset = offset
+        self._size = length
+        self._pool = pool or BufferPool(BLOCK_SIZE)
+        self._executor = executor
+        self._read_ahead = read_ahead
+        self._hasher = hasher
+        self._throttle = throttle
+        self._reader: Optional[ReadAheadReader] = None
+        # Seconds spent waiting for the disk while sending, over every time the payload was written
+        self.read_wait = 0.0
+
+    def _new_reader(self) -> ReadAheadReader:
+        return ReadAheadReader(
+            self._path, self._offset, self._size, self._pool, self._executor, self._read_ahead, self._hasher
+        )
+
+    def prefetch(self) -> None:
+        """Starts reading the first blocks while the connection is still being set up"""
+        if self._reader is None:
+            self._reader = self._new_reader()
+            self._reader.start()
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        raise TypeError("Unable to decode a file range payload")
+
+    async def write(self, writer: AbstractStreamWriter) -> None:
+        await self.write_with_length(writer, None)
+
+    async def write_with_length(self, writer: AbstractStreamWriter, content_length: Optional[int]) -> None:
+        remaining = self._size if content_length is None else min(self._size, content_length)
+        reader, self._reader = self._reader or self._new_reader(), None
+        # Buffers that were written but may still be referenced by the transport
+        sent: Deque[Tuple[bytearray, int]] = collections.deque()
+        try:
+            while remaining > 0:
+                waiting = time.monotonic()
+                block = await reader.read_block()
+                self.read_wait += time.monotonic() - waiting
+                if block is None:
+                    break
+                view, buffer = block
+                view = view[:remaining]
+                if self._throttle is not None:
+                    await self._throttle(len(view))
+                await writer.write(view)
+                sent.append((buffer, len(view)))
+                remaining -= len(view)
+                self._recycle_flushed(writer, reader, sent)
+        finally:
+            self._recycle_flushed(writer, reader, sent)
+            # Anything left may still be queued in the transport so it is dropped instead of being reused
+            await reader.close()
+
+    @staticmethod
+    def _recycle_flushed(
+        writer: AbstractStreamWriter, reader: ReadAheadReader, sent: Deque[Tuple[bytearray, int]]
+    ) -> None:
+        transport = getattr(writer, "transport", None)
+        if transport is None:
+            return
+        # The transport only ever holds the tail of what was written, older buffers are safe to reuse
+        buffered = transport.get_write_buffer_size()
+        queued = sum(size for _, size in sent)
+        while sent and queued - sent[0][1] >= buffered:
+            buffer, size = sent.popleft()
+            queued -= size
+            reader.recycle(buffer)
+
+    async def close(self) -> None:
+        if self._reader is not None:
+            await self._reader.close()
+            self._reader = None
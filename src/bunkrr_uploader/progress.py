@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import json
+import logging
+import shutil
+import sys
+import time
+from typing import Any, Deque, Dict, Hashable, List, Optional, TextIO, Tuple
+
+logger = logging.getLogger(__name__)
+
+MODES = ["auto", "bar", "log", "json", "none"]
+# Seconds between redraws of the terminal display and between summaries when there is no terminal
+BAR_INTERVAL = 0.5
+LOG_INTERVAL = 30.0
+# Seconds of recent progress the transfer rate is measured over
+RATE_WINDOW = 10.0
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+class ActiveFile:
+    __slots__ = ("name", "size", "sent", "started")
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.sent = 0
+        self.started = time.monotonic()
+
+
+class ProgressReporter:
+    """
+    One display for every upload that is running instead of a progress bar per file.
+
+    Uploads only add to counters, which are drawn every `interval` seconds no matter how many uploads there are. `bar`
+    redraws the total, throughput, ETA and the `top` files with the most left to send on a terminal, `log` writes a
+    summary line and `json` a JSON event per interval, which suits cron jobs and log collectors. `auto` draws a bar on
+    a terminal and logs summaries otherwise. Bytes count once the server acknowledged them.
+    """
+
+    def __init__(
+        self, mode: str = "auto", interval: Optional[float] = None, top: int = 5, stream: Optional[TextIO] = None
+    ):
+        self.stream = stream or sys.stderr
+        if mode == "auto":
+            mode = "bar" if self.stream.isatty() else "log"
+        self.mode = mode
+        self.interval = interval or (BAR_INTERVAL if mode == "bar" else LOG_INTERVAL)
+        self.top = top
+        self.files_total = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_total = 0
+        # Bytes of files that are done and bytes that went over the wire, which differ by skipped duplicates
+        self.bytes_done = 0
+        self.bytes_sent = 0
+        self.active: Dict[Hashable, ActiveFile] = {}
+        self.samples: Deque[Tuple[float, int]] = collections.deque()
+        self.started = time.monotonic()
+        self._lines = 0
+        self._users = 0
+        self._task: Optional[asyncio.Future] = None
+
+    def queued(self, size: int) -> None:
+        self.files_total += 1
+        self.bytes_total += size
+
+    def begin(self, key: Hashable, name: str, size: int) -> None:
+        if key not in self.active:
+            self.active[key] = ActiveFile(name, size)
+
+    def advance(self, key: Hashable, sent: int) -> None:
+        self.bytes_sent += sent
+        active = self.active.get(key)
+        if active:
+            active.sent += sent
+
+    def resumed(self, key: Hashable, sent: int) -> None:
+        """Sets how much of the file the server has at the start of an attempt, which is nothing when it starts over"""
+        active = self.active.get(key)
+        if active:
+            active.sent = sent
+
+    def completed(self, key: Hashable, size: int, success: bool) -> None:
+        self.active.pop(key, None)
+        self.files_done += 1
+        if success:
+            self.bytes_done += size
+        else:
+            self.files_failed += 1
+            self.bytes_total -= size
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self.samples.append((now, self.bytes_sent))
+        while len(self.samples) > 2 and self.samples[1][0] < now - RATE_WINDOW:
+            self.samples.popleft()
+        first_time, first_sent = self.samples[0]
+        rate = (self.bytes_sent - first_sent) / (now - first_time) if now > first_time else 0.0
+        done = self.bytes_done + sum(min(x.sent, x.size) for x in self.active.values())
+        remaining = max(self.bytes_total - done, 0)
+        return {
+            "files": self.files_done,
+            "filesTotal": self.files_total,
+            "failed": self.files_failed,
+            "bytes": done,
+            "bytesTotal": self.bytes_total,
+            "bytesSent": self.bytes_sent,
+            "bytesPerSecond": round(rate),
+            "eta": round(remaining / rate) if rate > 0 else None,
+            "elapsed": round(now - self.started, 1),
+            "active": len(self.active),
+        }
+
+    def top_files(self) -> List[ActiveFile]:
+        return sorted(self.active.values(), key=lambda x: x.sent - x.size)[: self.top]
+
+    def summary(self, snapshot: Dict[str, Any]) -> str:
+        failed = f" ({snapshot['failed']} failed)" if snapshot["failed"] else ""
+        return (
+            f"{snapshot['files']}/{snapshot['filesTotal']} files{failed}, "
+            f"{format_size(snapshot['bytes'])}/{format_size(snapshot['bytesTotal'])}, "
+            f"{format_size(snapshot['bytesPerSecond'])}/s, ETA {format_duration(snapshot['eta'])}, "
+            f"{snapshot['active']} uploading"
+        )
+
+    def render(self) -> None:
+        if self.mode == "none":
+            return
+        snapshot = self.snapshot()
+        if self.mode == "json":
+            top = [{"name": x.name, "sent": x.sent, "size": x.size} for x in self.top_files()]
+            self.stream.write(json.dumps({"event": "progress", "time": time.time(), **snapshot, "top": top}) + "\n")
+        elif self.mode == "log":
+            self.stream.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {self.summary(snapshot)}\n")
+        else:
+            width = shutil.get_terminal_size().columns
+            lines = [self.summary(snapshot)]
+            for active in self.top_files():
+                percent = active.sent / active.size if active.size else 1.0
+                sizes = f"{percent:4.0%} {format_size(active.sent)}/{format_size(active.size)}"
+                lines.append(f"  {active.name[: max(width - len(sizes) - 4, 8)]} {sizes}")
+            # Moves back over the last frame and clears it, the frame is written with a single write
+            clear = f"\x1b[{self._lines}F\x1b[J" if self._lines else ""
+            self.stream.write(clear + "\n".join(x[:width] for x in lines) + "\n")
+            self._lines = len(lines)
+        self.stream.flush()
+
+    async def _render_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.render()
+
+    async def __aenter__(self) -> "ProgressReporter":
+        # Uploads that run at the same time, such as daemon jobs, share the display
+        self._users += 1
+        if self._task is None and self.mode != "none":
+            self._task = asyncio.ensure_future(self._render_periodically())
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        self._users -= 1
+        if self._users or self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self.render()
+        self._lines = 0
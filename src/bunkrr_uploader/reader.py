@@ -0,0 +1,121 @@
+import asyncio
+import collections
+import threading
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Deque, List, Optional, Tuple
+
+from .hashindex import StreamHasher
+
+
+class BufferPool:
+    """Hands out fixed size read buffers and keeps up to `max_idle` of them around for reuse"""
+
+    def __init__(self, buffer_size: int, max_idle: int = 32):
+        self.buffer_size = buffer_size
+        self.max_idle = max_idle
+        self._idle: List[bytearray] = []
+
+    def acquire(self) -> bytearray:
+        if self._idle:
+            return self._idle.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray) -> None:
+        if len(self._idle) < self.max_idle:
+            self._idle.append(buffer)
+
+
+class ReadAheadReader:
+    """
+    Reads `length` bytes of a file starting at `offset` in a thread pool, keeping up to `depth` blocks read ahead of
+    the one currently being consumed so disk latency overlaps with sending.
+
+    Blocks are yielded as (memoryview, buffer) pairs, the buffer has to be given back with `recycle` once nothing
+    references the memoryview anymore.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        offset: int,
+        length: int,
+        pool: BufferPool,
+        executor: Optional[Executor] = None,
+        depth: int = 2,
+        hasher: Optional[StreamHasher] = None,
+    ):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.pool = pool
+        self.executor = executor
+        self.depth = max(depth, 1)
+        self.hasher = hasher
+
+        self._file = None
+        self._lock = threading.Lock()
+        self._next_offset = offset
+        self._remaining = length
+        self._pending: Deque[Tuple[asyncio.Future, bytearray, int]] = collections.deque()
+
+    def _read_into(self, buffer: bytearray, position: int, size: int) -> int:
+        # Prefetched reads may run on different threads at the same time so the seek and read have to stay together
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "rb")
+            self._file.seek(position)
+            read = self._file.readinto(memoryview(buffer)[:size])
+        # Hashing here keeps it off the event loop and saves reading the file a second time
+        if self.hasher:
+            self.hasher.update(position, memoryview(buffer)[:read])
+        return read
+
+    def _close_file(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _fill(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._remaining > 0 and len(self._pending) < self.depth:
+            size = min(self.pool.buffer_size, self._remaining)
+            buffer = self.pool.acquire()
+            future = loop.run_in_executor(self.executor, self._read_into, buffer, self._next_offset, size)
+            self._pending.append((future, buffer, size))
+            self._next_offset += size
+            self._remaining -= size
+
+    def start(self) -> None:
+        """Starts reading ahead before the blocks are consumed"""
+        self._fill()
+
+    async def read_block(self) -> Optional[Tuple[memoryview, bytearray]]:
+        """Returns the next block or None once the whole range has been read"""
+        self._fill()
+        if not self._pending:
+            return None
+        future, buffer, size = self._pending.popleft()
+        read = await future
+        if read < size:
+            self.pool.release(buffer)
+            raise EOFError(f"{self.path} was shorter than expected while reading it")
+        # Queue the next read before handing this block out so the disk stays busy while it is sent
+        self._fill()
+        return memoryview(buffer)[:read], buffer
+
+    def recycle(self, buffer: bytearray) -> None:
+        self.pool.release(buffer)
+
+    async def close(self) -> None:
+        # Reads that are still running own their buffers, wait for them so the buffers can be reused safely
+        pending, self._pending = self._pending, collections.deque()
+        for future, buffer, _ in pending:
+            try:
+                await future
+            except Exception:
+                continue
+            self.pool.release(buffer)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._close_file)
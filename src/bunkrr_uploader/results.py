@@ -0,0 +1,226 @@
+import abc
+import asyncio
+import csv
+import json
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .types import UploadResponse
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ["csv", "jsonl", "sqlite"]
+# Columns of the CSV and SQLite results, anything else the server returns is kept as JSON in `extra`
+FIELDS = [
+    "filePath",
+    "fileName",
+    "fileSize",
+    "albumid",
+    "uploadSuccess",
+    "name",
+    "url",
+    "fileMD5",
+    "filePathMD5",
+    "fileNameMD5",
+    "time",
+    "extra",
+]
+
+
+def result_record(response: UploadResponse) -> Dict[str, Any]:
+    """Flattens a response to the record of its file with when it finished"""
+    uploaded = (response.get("files") or [{}])[0] or {}
+    record = {**uploaded, "time": round(time.time(), 3)}
+    if not response.get("success"):
+        # Files that failed before the server saw them have no uploadSuccess yet
+        record["uploadSuccess"] = False
+    return record
+
+
+def split_extra(record: Dict[str, Any]) -> Dict[str, Any]:
+    row = {key: record.get(key) for key in FIELDS if key != "extra"}
+    extra = {key: value for key, value in record.items() if key not in FIELDS}
+    row["extra"] = json.dumps(extra) if extra else None
+    return row
+
+
+def record_uploaded(record: Dict[str, Any]) -> bool:
+    return str(record.get("uploadSuccess")) in ("True", "true", "1", "duplicate")
+
+
+def record_size(size: Any) -> int:
+    # Sizes come back as strings from CSV
+    return int(float(size or 0))
+
+
+def record_key(path: Any, size: Any, album_id: Any) -> Tuple[str, int, str]:
+    return str(path), record_size(size), str(album_id or "")
+
+
+def detect_format(path: Path) -> str:
+    suffix = path.suffix.lower()
+    if suffix in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    if suffix in (".sqlite", ".sqlite3", ".db"):
+        return "sqlite"
+    return "csv"
+
+
+class ResultSink(abc.ABC):
+    """
+    Appends the outcome of every upload to a file as it finishes so a run that crashes keeps what it did.
+
+    Records are buffered and written with an fsync once `batch_size` of them are waiting or the oldest has waited
+    `flush_interval` seconds, nothing is kept after that so memory doesn't grow with the number of files. An existing
+    file is appended to and its records can be read back with `records()`, which is how the next run knows what was
+    already uploaded.
+    """
+
+    def __init__(self, path: Path, batch_size: int = 100, flush_interval: float = 5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending: List[Dict[str, Any]] = []
+        self.written = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, response: UploadResponse) -> None:
+        self.pending.append(result_record(response))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._timer = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        self._write(self.pending)
+        self.written += len(self.pending)
+        self.pending = []
+
+    @abc.abstractmethod
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def records(self) -> Iterator[Dict[str, Any]]:
+        pass
+
+    def uploaded(self) -> Iterator[Dict[str, Any]]:
+        """Records of files that made it to the server, including skipped duplicates"""
+        return (x for x in self.records() if record_uploaded(x))
+
+    def close(self) -> None:
+        self.flush()
+
+
+class FileSink(ResultSink):
+    def __init__(self, path: Path, batch_size: int = 100, flush_interval: float = 5.0):
+        super().__init__(path, batch_size, flush_interval)
+        self.file = open(path, "a", newline="", encoding="utf-8")
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        self._write_lines(records)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    @abc.abstractmethod
+    def _write_lines(self, records: List[Dict[str, Any]]) -> None:
+        pass
+
+    def close(self) -> None:
+        super().close()
+        self.file.close()
+
+
+class CsvSink(FileSink):
+    def __init__(self, path: Path, batch_size: int = 100, flush_interval: float = 5.0):
+        exists = path.exists() and path.stat().st_size > 0
+        super().__init__(path, batch_size, flush_interval)
+        self.writer = csv.DictWriter(self.file, dialect="excel", fieldnames=FIELDS)
+        if not exists:
+            self.writer.writeheader()
+        elif not self._ends_with_newline():
+            # The last line was cut short by a crash so new records start on a line of their own
+            self.file.write("\r\n")
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _write_lines(self, records: List[Dict[str, Any]]) -> None:
+        self.writer.writerows(split_extra(x) for x in records)
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        with open(self.path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f, dialect="excel"):
+                # A line cut short by a crash is missing its last columns
+                if None in row.values() or None in row:
+                    continue
+                extra = row.pop("extra", None)
+                yield {**(json.loads(extra) if extra else {}), **row}
+
+
+class JsonlSink(FileSink):
+    def _write_lines(self, records: List[Dict[str, Any]]) -> None:
+        self.file.write("".join(json.dumps(x) + "\n" for x in records))
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+class SqliteSink(ResultSink):
+    def __init__(self, path: Path, batch_size: int = 100, flush_interval: float = 5.0):
+        super().__init__(path, batch_size, flush_interval)
+        self.db = sqlite3.connect(str(path), isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Every batch is a transaction that has to be on disk when it commits
+        self.db.execute("PRAGMA synchronous=FULL")
+        types = {"fileSize": "INTEGER", "time": "REAL"}
+        columns = ", ".join(f"{x} {types.get(x, 'TEXT')}" for x in FIELDS)
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, {columns})")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_path ON results (filePath)")
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        rows = [split_extra(x) for x in records]
+        values = [tuple(str(x[key]) if key == "uploadSuccess" else x[key] for key in FIELDS) for x in rows]
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                f"INSERT INTO results ({', '.join(FIELDS)}) VALUES ({', '.join('?' for _ in FIELDS)})", values
+            )
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        for row in self.db.execute(f"SELECT {', '.join(FIELDS)} FROM results ORDER BY id"):
+            record = dict(zip(FIELDS, row))
+            extra = record.pop("extra", None)
+            yield {**(json.loads(extra) if extra else {}), **record}
+
+    def close(self) -> None:
+        super().close()
+        self.db.close()
+
+
+SINKS = {"csv": CsvSink, "jsonl": JsonlSink, "sqlite": SqliteSink}
+
+
+def open_sink(path: Path, result_format: Optional[str] = None, **kwargs: Any) -> ResultSink:
+    return SINKS[result_format or detect_format(path)](path, **kwargs)
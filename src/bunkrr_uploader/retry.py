@@ -0,0 +1,146 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from typing import Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Kinds of failures, they decide whether and how soon a request is tried again
+# The connection broke, timed out or the server had an internal error
+TRANSIENT = "transient"
+# The server asked us to slow down with a 429
+THROTTLED = "throttled"
+# The server answered with success false, such as for chunks it already threw away
+REJECTED = "rejected"
+# Trying again can't help, such as a missing file or a token that isn't valid
+PERMANENT = "permanent"
+
+
+class UploadError(Exception):
+    def __init__(
+        self, message: str, kind: str = TRANSIENT, retry_after: Optional[float] = None, response: Optional[dict] = None
+    ):
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+        # What the server answered, if it answered with JSON
+        self.response = response
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+def classify_status(status: int) -> str:
+    if status == 429:
+        return THROTTLED
+    if status >= 500 or status == 408:
+        return TRANSIENT
+    if status in (401, 403):
+        return PERMANENT
+    return REJECTED
+
+
+def classify(error: BaseException) -> str:
+    if isinstance(error, UploadError):
+        return error.kind
+    if isinstance(error, aiohttp.ClientResponseError):
+        return classify_status(error.status)
+    if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)):
+        return TRANSIENT
+    # Anything else, such as a file that can't be read, happens again on every attempt
+    return PERMANENT
+
+
+async def response_json(resp: aiohttp.ClientResponse, what: str) -> dict:
+    """
+    Returns the JSON body of a successful response or raises an UploadError with the kind of failure.
+    Error pages that aren't JSON, such as those of a proxy in front of a node, are classified by their status.
+    """
+    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+    try:
+        response = await resp.json(content_type=None)
+    except ValueError:
+        response = None
+    if resp.status >= 400 or not isinstance(response, dict):
+        description = response.get("description") if isinstance(response, dict) else None
+        kind = classify_status(resp.status) if resp.status >= 400 else TRANSIENT
+        raise UploadError(
+            f"{what} failed with HTTP {resp.status}: {description or resp.reason}",
+            kind,
+            retry_after,
+            response if isinstance(response, dict) else None,
+        )
+    if not response.get("success"):
+        raise UploadError(f"{what} was refused: {response.get('description')}", REJECTED, retry_after, response)
+    return response
+
+
+class RetryPolicy:
+    """
+    Decides how long to wait before trying a failed request again.
+
+    Waits grow exponentially from `base` up to `cap` seconds with jitter so requests that failed together don't
+    come back together. A Retry-After from the server is honoured up to `max_retry_after` seconds.
+    """
+
+    def __init__(self, base: float = 0.5, cap: float = 30.0, max_retry_after: float = 300.0):
+        self.base = base
+        self.cap = cap
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        ceiling = min(self.cap, self.base * 2**attempt)
+        # Being throttled means the node is busy so the waits start higher
+        if error is not None and classify(error) == THROTTLED:
+            ceiling = min(self.cap, ceiling * 4)
+        return random.uniform(ceiling / 2, ceiling)
+
+    async def wait(self, attempt: int, error: Optional[BaseException] = None) -> None:
+        delay = self.delay(attempt, error)
+        if delay > 0:
+            logger.debug(f"Waiting {delay:.1f}s before trying again")
+            await asyncio.sleep(delay)
+
+
+class RetryBudget:
+    """
+    Limits retries to each node to a share of its successful requests so a node that fails everything isn't flooded
+    with retries that would take connections away from the uploads that work.
+
+    Every node starts with `max_tokens`. A retry takes one token and a success gives back `ratio` of one. Retries stop
+    while a node has fewer than half of its tokens until enough requests to it succeed again.
+    """
+
+    def __init__(self, max_tokens: float = 20, ratio: float = 0.2):
+        self.max_tokens = max_tokens
+        self.ratio = ratio
+        self.tokens: Dict[str, float] = {}
+
+    def success(self, server: str) -> None:
+        self.tokens[server] = min(self.tokens.get(server, self.max_tokens) + self.ratio, self.max_tokens)
+
+    def try_retry(self, server: str) -> bool:
+        tokens = self.tokens.get(server, self.max_tokens)
+        if tokens < self.max_tokens / 2:
+            return False
+        self.tokens[server] = tokens - 1
+        return True
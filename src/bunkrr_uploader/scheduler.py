@@ -0,0 +1,105 @@
+import asyncio
+import fnmatch
+import heapq
+import itertools
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+POLICIES = ["fifo", "largest", "smallest"]
+
+
+class UploadScheduler:
+    """
+    Holds up to `capacity` files waiting to be uploaded and hands them out in the order of a policy.
+
+    - fifo: in the order the files were found
+    - largest: biggest first so one huge file doesn't start last and hold up the whole batch
+    - smallest: smallest first to finish as many files as possible early
+
+    Files matching one of the `priorities` globs always go first, in the order of the globs. Files up to
+    `small_size` bytes are kept apart so workers that only upload small files can take them to fill idle slots while
+    big files are busy sending chunks.
+    """
+
+    def __init__(
+        self, policy: str = "fifo", priorities: Optional[List[str]] = None, capacity: int = 1000, small_size: int = 0
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy {policy}, use one of {', '.join(POLICIES)}")
+        self.policy = policy
+        self.priorities = priorities or []
+        self.capacity = capacity
+        self.small_size = small_size
+        self._small: List[Tuple[tuple, Path, int, Optional[str]]] = []
+        self._large: List[Tuple[tuple, Path, int, Optional[str]]] = []
+        self._counter = itertools.count()
+        self._closed = False
+        self._condition = asyncio.Condition()
+
+    def __len__(self) -> int:
+        return len(self._small) + len(self._large)
+
+    def _key(self, path: Path, size: int) -> tuple:
+        rank = next(
+            (
+                i
+                for i, x in enumerate(self.priorities)
+                if fnmatch.fnmatch(str(path), x) or fnmatch.fnmatch(path.name, x)
+            ),
+            len(self.priorities),
+        )
+        if self.policy == "largest":
+            order = -size
+        elif self.policy == "smallest":
+            order = size
+        else:
+            order = 0
+        # The counter keeps equal files in the order they were found and stops paths from being compared
+        return rank, order, next(self._counter)
+
+    async def put(self, path: Path, size: int, album_id: Optional[str] = None) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: len(self) < self.capacity)
+            heap = self._small if size <= self.small_size else self._large
+            heapq.heappush(heap, (self._key(path, size), path, size, album_id))
+            self._condition.notify_all()
+
+    async def close(self) -> None:
+        """No more files will be added, waiting workers get None once everything was handed out"""
+        async with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    async def get(
+        self, small_only: bool = False, batch_count: int = 1, batch_bytes: int = 0
+    ) -> Optional[List[Tuple[Path, int, Optional[str]]]]:
+        """
+        Waits for the next file to upload, or only for a small file with `small_only`. When it is small more small
+        files going to the same album are added up to `batch_count` files and `batch_bytes` so they can be sent
+        together.
+        """
+        async with self._condition:
+            if small_only:
+                await self._condition.wait_for(lambda: self._small or self._closed)
+                heap = self._small
+            else:
+                await self._condition.wait_for(lambda: len(self) or self._closed)
+                heaps = [x for x in [self._small, self._large] if x]
+                heap = min(heaps, key=lambda x: x[0][0]) if heaps else None
+            if not heap:
+                return None
+            _, path, size, album_id = heapq.heappop(heap)
+            items = [(path, size, album_id)]
+            if heap is self._small:
+                total = size
+                while (
+                    self._small
+                    and len(items) < batch_count
+                    and total + self._small[0][2] <= batch_bytes
+                    and self._small[0][3] == album_id
+                ):
+                    _, path, size, _ = heapq.heappop(self._small)
+                    items.append((path, size, album_id))
+                    total += size
+            self._condition.notify_all()
+            return items
@@ -0,0 +1,228 @@
+import asyncio
+import datetime
+import functools
+import json
+import logging
+import signal
+import time
+import urllib.parse
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from .state import UNIT_MULTIPLIER, parse_size
+
+logger = logging.getLogger(__name__)
+
+Rate = Optional[float]
+
+
+def parse_rate(rate: Union[str, int, float, None]) -> Rate:
+    """Bytes per second from something like `20MB` or `512kb`, nothing or 0 means unlimited"""
+    if rate is None or isinstance(rate, (int, float)):
+        return float(rate) if rate else None
+    rate = rate.strip().lower()
+    if rate in ("", "0", "none", "unlimited"):
+        return None
+    if rate.isdigit():
+        return float(rate) or None
+    # parse_size counts unknown units as bytes which would throttle to a crawl on a typo
+    if rate.lstrip("0123456789") not in UNIT_MULTIPLIER:
+        raise ValueError(f"Unknown unit in {rate}")
+    return float(parse_size(rate)) or None
+
+
+def parse_node_rate(value: str) -> Tuple[Optional[str], Rate]:
+    """Reads `5MB` as the limit of every node or `host=2MB` as the limit of the node with that URL or host"""
+    node, _, rate = value.rpartition("=")
+    return node or None, parse_rate(rate)
+
+
+def parse_schedule(schedule: Union[str, Dict[str, Any], None]) -> List[Tuple[datetime.time, Rate]]:
+    """Reads `08:00=10MB,20:00=0` or the same as a dict into times of day and the rate from then on"""
+    if not schedule:
+        return []
+    if isinstance(schedule, str):
+        schedule = dict(x.split("=", 1) for x in schedule.split(",") if x.strip())
+    entries = [(datetime.time.fromisoformat(start.strip()), parse_rate(rate)) for start, rate in schedule.items()]
+    return sorted(entries, key=lambda x: x[0])
+
+
+def scheduled_rate(schedule: List[Tuple[datetime.time, Rate]], now: datetime.time) -> Rate:
+    # Before the first entry of the day the last entry of the previous day still applies
+    current = schedule[-1][1]
+    for start, rate in schedule:
+        if start <= now:
+            current = rate
+    return current
+
+
+class TokenBucket:
+    """
+    Lets `rate` bytes per second through with bursts of at most `burst` seconds worth of bytes.
+
+    Waiters are served one at a time in the order they came, so uploads sending blocks of the same size each get an
+    equal share of the rate and whatever one of them doesn't use goes to the others. Anything bigger than the bucket is
+    let through once the bucket is full and paid back before the next waiter gets its turn.
+    """
+
+    def __init__(self, rate: Rate = None, burst: float = 0.25):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def capacity(self) -> float:
+        return self.rate * self.burst if self.rate else 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: Rate) -> None:
+        self._refill()
+        self.rate = rate
+        if not rate:
+            self.tokens = 0.0
+
+    async def acquire(self, size: int) -> None:
+        if not self.rate:
+            return
+        async with self._lock:
+            self._refill()
+            while self.rate and self.tokens < min(size, self.capacity):
+                await asyncio.sleep((min(size, self.capacity) - self.tokens) / self.rate)
+                self._refill()
+            if self.rate:
+                self.tokens -= size
+
+
+class BandwidthShaper:
+    """
+    Caps how fast uploads are sent, in total with `max_rate` and to each node with `node_rate` or `node_rates` keyed
+    by the node's URL or host.
+
+    A time of day `schedule` overrides `max_rate`. Limits can also be kept in a JSON file like
+    `{"max": "20MB", "node": "5MB", "nodes": {"host": "2MB"}, "schedule": {"08:00": "10MB", "20:00": "0"}}` which is
+    read again when it changes or on SIGHUP. Worker processes each get `share` of every limit so together they stay
+    within it.
+    """
+
+    def __init__(
+        self,
+        max_rate: Rate = None,
+        node_rate: Rate = None,
+        node_rates: Optional[Dict[str, Rate]] = None,
+        schedule: Optional[List[Tuple[datetime.time, Rate]]] = None,
+        path: Optional[Path] = None,
+        share: float = 1.0,
+        interval: float = 10.0,
+    ):
+        self.max_rate = max_rate
+        self.node_rate = node_rate
+        self.node_rates = node_rates or {}
+        self.schedule = schedule or []
+        self.path = path
+        self.share = share
+        self.interval = interval
+        self.total = TokenBucket()
+        self.nodes: Dict[str, TokenBucket] = {}
+        self._mtime: Optional[float] = None
+        self._task: Optional[asyncio.Future] = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether there is anything that can limit uploads, now or later on"""
+        return bool(self.max_rate or self.node_rate or self.node_rates or self.schedule or self.path)
+
+    def _scaled(self, rate: Rate) -> Rate:
+        return rate * self.share if rate else None
+
+    def node_limit(self, server: str) -> Rate:
+        host = urllib.parse.urlsplit(server).hostname
+        rate = self.node_rates.get(server, self.node_rates.get(host, self.node_rate))
+        return self._scaled(rate)
+
+    def total_limit(self) -> Rate:
+        if self.schedule:
+            return self._scaled(scheduled_rate(self.schedule, datetime.datetime.now().time()))
+        return self._scaled(self.max_rate)
+
+    def apply(self) -> None:
+        rate = self.total_limit()
+        if rate != self.total.rate:
+            logger.info(f"Limiting uploads to {rate / 1024**2:.2f}MiB/s" if rate else "Not limiting uploads anymore")
+            self.total.set_rate(rate)
+        for server, bucket in self.nodes.items():
+            bucket.set_rate(self.node_limit(server))
+
+    def reload(self, force: bool = False) -> None:
+        """Reads the limits file again if it changed"""
+        if self.path is None:
+            return
+        try:
+            mtime = self.path.stat().st_mtime
+            if not force and mtime == self._mtime:
+                return
+            limits = json.loads(self.path.read_text())
+            self.max_rate = parse_rate(limits.get("max"))
+            self.node_rate = parse_rate(limits.get("node"))
+            self.node_rates = {key: parse_rate(value) for key, value in (limits.get("nodes") or {}).items()}
+            self.schedule = parse_schedule(limits.get("schedule"))
+            self._mtime = mtime
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error(f"Unable to read the bandwidth limits from {self.path}: {e}")
+            return
+        logger.info(f"Read the bandwidth limits from {self.path}")
+        self.apply()
+
+    def rate(self, server: str) -> Rate:
+        """The lowest limit uploads to `server` are held to right now, None when they aren't limited"""
+        node = self.nodes[server].rate if server in self.nodes else self.node_limit(server)
+        rates = [x for x in (self.total.rate, node) if x]
+        return min(rates) if rates else None
+
+    def throttle(self, server: str) -> Optional[Callable[[int], Awaitable[None]]]:
+        if not self.enabled:
+            return None
+        if server not in self.nodes:
+            self.nodes[server] = TokenBucket(self.node_limit(server))
+        return functools.partial(self.acquire, self.nodes[server])
+
+    async def acquire(self, node: TokenBucket, size: int) -> None:
+        await node.acquire(size)
+        await self.total.acquire(size)
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        self.reload(force=True)
+        self.apply()
+        self._task = asyncio.ensure_future(self._update_periodically())
+        if self.path:
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload, True)
+            except (NotImplementedError, AttributeError, RuntimeError):
+                # There is no SIGHUP on Windows and signals only work in the main thread
+                pass
+
+    async def _update_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.reload()
+            self.apply()
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self.path:
+            try:
+                asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            except (NotImplementedError, AttributeError, RuntimeError):
+                pass
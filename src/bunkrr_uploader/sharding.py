@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+from typing import Any, AsyncIterable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .progress import BAR_INTERVAL, ProgressReporter
+from .types import UploadResponse
+
+logger = logging.getLogger(__name__)
+
+# Files handed to a worker process at a time, enough to keep the queues cheap and small enough to spread files evenly
+SHARD_SIZE = 8
+
+
+class ForwardedProgress(ProgressReporter):
+    """
+    Progress of a worker process, sent to the coordinator through `results` every `interval` seconds instead of being
+    shown. Files are queued by the coordinator so only what happens to them afterwards is forwarded.
+    """
+
+    def __init__(self, results: Any, interval: float = BAR_INTERVAL):
+        super().__init__("forward", interval)
+        self.results = results
+        self.events: List[Tuple[Any, ...]] = []
+
+    def queued(self, size: int) -> None:
+        pass
+
+    def begin(self, key: Hashable, name: str, size: int) -> None:
+        self.events.append(("begin", str(key), name, size))
+
+    def advance(self, key: Hashable, sent: int) -> None:
+        self.events.append(("advance", str(key), sent))
+
+    def resumed(self, key: Hashable, sent: int) -> None:
+        self.events.append(("resumed", str(key), sent))
+
+    def completed(self, key: Hashable, size: int, success: bool) -> None:
+        self.events.append(("completed", str(key), size, success))
+
+    def render(self) -> None:
+        if self.events:
+            self.results.put(("progress", self.events))
+            self.events = []
+
+
+def worker_main(
+    token: str, max_connections: int, retries: int, options: Dict[str, Any], tasks: Any, results: Any
+) -> None:
+    try:
+        asyncio.run(run_worker(token, max_connections, retries, options, tasks, results))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_worker(
+    token: str, max_connections: int, retries: int, options: Dict[str, Any], tasks: Any, results: Any
+) -> None:
+    """Uploads the files it takes from `tasks` with its own event loop and connections and sends back the results"""
+    from .bunkrr_uploader import BunkrrUploader
+
+    client = BunkrrUploader(token, max_connections, retries, options)
+    client.api.progress = ForwardedProgress(results)
+    loop = asyncio.get_running_loop()
+
+    async def items() -> AsyncIterable[tuple]:
+        while True:
+            shard = await loop.run_in_executor(None, tasks.get)
+            if shard is None:
+                return
+            for item in shard:
+                yield item
+
+    try:
+        await client.init()
+        await client.api.upload_files(items(), None, results.put)
+    finally:
+        await client.api.close()
+        results.put(None)
+
+
+class ShardedUploader:
+    """
+    Spreads uploads over `processes` worker processes so TLS, multipart encoding and hashing use more than one core.
+
+    Each worker runs its own BunkrrAPI and takes a few files at a time from a shared queue, so a worker that got big
+    files simply takes fewer of them. Workers share the upload journal, the hash index and the cached server state
+    through their SQLite and JSON files. This process finds the files and albums and collects every result.
+    The chunks of a single file are always uploaded by one worker since they share a dzuuid and a node.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        max_connections: int,
+        retries: int,
+        options: Dict[str, Any],
+        processes: int,
+        progress: Optional[ProgressReporter] = None,
+    ):
+        self.token = token
+        self.max_connections = max_connections
+        self.retries = retries
+        self.options = options
+        self.processes = processes
+        # Workers forward what their uploads do every so often and it is all shown here
+        self.progress = progress or ProgressReporter("none")
+        # Spawned workers don't inherit the running event loop or open connections of this process
+        self.context = multiprocessing.get_context("spawn")
+
+    async def upload_files(self, items: AsyncIterable[tuple], result_callback: Callable[[UploadResponse], Any]) -> None:
+        loop = asyncio.get_running_loop()
+        tasks = self.context.Queue(maxsize=self.processes * 4)
+        results = self.context.Queue()
+        workers = [
+            self.context.Process(
+                target=worker_main,
+                args=(self.token, self.max_connections, self.retries, {**self.options, "worker": i}, tasks, results),
+                name=f"bunkrr-upload-{i}",
+                daemon=True,
+            )
+            for i in range(self.processes)
+        ]
+        for worker in workers:
+            worker.start()
+        logger.info(f"Started {self.processes} upload processes")
+
+        def put(shard: Optional[List[tuple]]) -> None:
+            while True:
+                try:
+                    tasks.put(shard, timeout=1)
+                    return
+                except queue.Full:
+                    if not any(x.is_alive() for x in workers):
+                        raise Exception("Every upload process exited")
+
+        async def produce() -> None:
+            shard = []
+            async for item in items:
+                shard.append(item)
+                self.progress.queued(item[1])
+                if len(shard) >= SHARD_SIZE:
+                    await loop.run_in_executor(None, put, shard)
+                    shard = []
+            if shard:
+                await loop.run_in_executor(None, put, shard)
+            for _ in workers:
+                await loop.run_in_executor(None, put, None)
+
+        def next_result() -> Any:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                return queue.Empty
+
+        producer = asyncio.ensure_future(produce())
+        finished = 0
+        try:
+            async with self.progress:
+                while finished < len(workers):
+                    result = await loop.run_in_executor(None, next_result)
+                    if result is queue.Empty:
+                        if producer.done() and producer.exception():
+                            raise producer.exception()
+                        # Workers that died without saying so won't send anything anymore
+                        if not any(x.is_alive() for x in workers):
+                            logger.error(f"{len(workers) - finished} upload processes exited unexpectedly")
+                            break
+                        continue
+                    if result is None:
+                        finished += 1
+                    elif isinstance(result, tuple):
+                        for event, *args in result[1]:
+                            getattr(self.progress, event)(*args)
+                    else:
+                        result_callback(result)
+            await producer
+        finally:
+            producer.cancel()
+            for worker in workers:
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class FilePart:
+    """
+    A byte range of a file that is too big for the server, uploaded as a file of its own named like `video.mkv.001`.
+
+    Nothing is copied, the range is streamed straight from the original file.
+    """
+
+    def __init__(self, path: Path, number: int, count: int, offset: int, size: int):
+        self.path = path
+        self.number = number
+        self.count = count
+        self.offset = offset
+        self.size = size
+
+    @property
+    def name(self) -> str:
+        return f"{self.path.name}.{self.number:03d}"
+
+    def __str__(self) -> str:
+        return str(self.path.with_name(self.name))
+
+    def __repr__(self) -> str:
+        return f"FilePart({str(self)!r}, offset={self.offset}, size={self.size})"
+
+    def _key(self) -> Tuple[Path, int, int]:
+        return self.path, self.offset, self.size
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, FilePart) and self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+
+UploadSource = Union[Path, FilePart]
+
+
+def split_file(path: Path, file_size: int, part_size: int) -> List[FilePart]:
+    count = -(-file_size // part_size)
+    return [
+        FilePart(path, i + 1, count, i * part_size, min(part_size, file_size - i * part_size)) for i in range(count)
+    ]
+
+
+def source_range(file: UploadSource) -> Tuple[Path, int]:
+    """Returns the file on disk to read from and where in it the upload starts"""
+    if isinstance(file, FilePart):
+        return file.path, file.offset
+    return file, 0
+
+
+def source_size(file: UploadSource) -> int:
+    if isinstance(file, FilePart):
+        return file.size
+    return os.stat(file).st_size
+
+
+def manifest_path(path: Path, directory: Path) -> Path:
+    """
+    Below `directory` at the file's absolute path so files with the same name don't collide. Manifests are kept out of
+    the uploaded directory so the next upload of it doesn't pick them up as files of their own.
+    """
+    absolute = path.resolve()
+    return directory.joinpath(*absolute.parts[1:]).with_name(f"{path.name}.manifest.json")
+
+
+def write_manifest(path: Path, parts: List[FilePart], uploaded: Dict[str, dict], directory: Path) -> Path:
+    """
+    Writes what is needed to join the parts of a split file again, `uploaded` has the response for each part keyed
+    by the part's path. Joining is simply `cat video.mkv.0* > video.mkv`.
+    """
+    manifest = {
+        "name": path.name,
+        "size": sum(x.size for x in parts),
+        "parts": [
+            {
+                "name": part.name,
+                "offset": part.offset,
+                "size": part.size,
+                "md5": uploaded.get(str(part), {}).get("fileMD5"),
+                "url": uploaded.get(str(part), {}).get("url"),
+                "uploadSuccess": uploaded.get(str(part), {}).get("uploadSuccess"),
+            }
+            for part in parts
+        ],
+    }
+    target = manifest_path(path, directory)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with open(target, "w") as f:
+        json.dump(manifest, f, indent=2)
+    logger.info(f"Saved the manifest to join the parts of {path.name} to {target}")
+    return target
@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .types import CheckResponse, ServerLimits
+
+logger = logging.getLogger(__name__)
+
+UNIT_MULTIPLIER = {"b": 1, "kb": 1024, "mb": 1024**2, "gb": 1024**3, "tb": 1024**4}
+
+
+def parse_size(size: str) -> int:
+    match = re.match(r"^(\d+)([a-z]+)$", size.lower())
+    if not match:
+        raise ValueError("Invalid input format")
+    value, unit = match.groups()
+    return int(value) * UNIT_MULTIPLIER.get(unit, 1)
+
+
+def parse_limits(check: CheckResponse) -> ServerLimits:
+    max_file_size = check.get("maxSize", "0B")
+    max_chunk_size = check.get("chunkSize", {}).get("max", "0B")
+    # Choose a chunk size, default or max
+    chunk_size = check.get("chunkSize", {}).get("default", "0B")
+
+    if max_file_size == "0B" or chunk_size == "0B":
+        raise Exception("Invalid max file size or chunk size")
+
+    return {
+        "maxFileSize": parse_size(max_file_size),
+        "chunkSize": parse_size(chunk_size),
+        "maxChunkSize": parse_size(max_chunk_size if max_chunk_size != "0B" else chunk_size),
+        "chunkTimeout": check.get("chunkSize", {}).get("timeout"),
+        "blacklistExtensions": check.get("stripTags", {}).get("blacklistExtensions", []),
+    }
+
+
+class StateCache:
+    """
+    Keeps what the server told us, such as its limits and whether the token is valid, in a JSON file between runs.
+
+    Entries older than `ttl` seconds are stale. They are still returned so a run can start right away while they are
+    refreshed in the background. Without a `path` nothing is kept and every run asks the server again.
+    """
+
+    def __init__(self, path: Optional[Path] = None, ttl: float = 3600):
+        self.path = path
+        self.ttl = ttl
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if path and path.exists():
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable state file {path}: {e}")
+
+    def get(self, key: str) -> Tuple[Optional[Any], bool]:
+        """Returns the cached value, or None, and whether it is still fresh"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, False
+        return entry["value"], time.time() - entry["updated"] < self.ttl
+
+    def set(self, key: str, value: Any) -> None:
+        self.entries[key] = {"value": value, "updated": time.time()}
+        self.save()
+
+    def expire(self, key: str) -> None:
+        """Makes the next lookup refresh the entry, the value can still be used until then"""
+        if key in self.entries:
+            self.entries[key]["updated"] = 0
+            self.save()
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Written to a temporary file first so a crash never leaves half a state file behind, every process has its own
+        temporary = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(temporary, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temporary, self.path)
@@ -0,0 +1,236 @@
+import asyncio
+import bisect
+import contextlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def label_key(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = ((key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Telemetry:
+    """
+    Counters, gauges and latency histograms of what the uploader does along with timing spans.
+
+    Spans are written to a JSON-lines `trace_path` as they end and their durations go into a histogram of the same
+    name. Metrics are exported in the Prometheus text format to `metrics_path` every `interval` seconds, for the
+    node_exporter textfile collector, and on `/metrics` of `metrics_port`. Gauges are read from callbacks when they are
+    exported. Every metric gets the `labels` given here, such as the worker process it came from.
+    """
+
+    prefix = "bunkrr_"
+
+    def __init__(
+        self,
+        trace_path: Optional[Path] = None,
+        metrics_path: Optional[Path] = None,
+        metrics_port: Optional[int] = None,
+        interval: float = 10,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.metrics_path = Path(metrics_path) if metrics_path else None
+        self.metrics_port = metrics_port
+        self.interval = interval
+        self.labels = labels or {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.help: Dict[str, str] = {}
+        self.trace = None
+        if trace_path:
+            Path(trace_path).parent.mkdir(parents=True, exist_ok=True)
+            # Line buffered so a run that is killed still leaves every span that ended
+            self.trace = open(trace_path, "a", buffering=1)
+        self._tasks: List[asyncio.Future] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether anything is exported, request tracing is only worth its overhead when it is"""
+        return bool(self.trace or self.metrics_path or self.metrics_port is not None)
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        series = self.counters.setdefault(name, {})
+        key = label_key({**self.labels, **labels})
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        series = self.histograms.setdefault(name, {})
+        key = label_key({**self.labels, **labels})
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(seconds)
+
+    def gauge(self, name: str, read: Callable[[], float], description: str = "") -> None:
+        self.gauges[name] = read
+        if description:
+            self.help[name] = description
+
+    def record_span(self, name: str, started: float, seconds: float, **attributes: Any) -> None:
+        """For spans that were timed elsewhere, `started` is a time.time() timestamp"""
+        self.observe(f"{name}_seconds", seconds, **{k: v for k, v in attributes.items() if k in ("node", "result")})
+        if self.trace:
+            line = {"span": name, "start": round(started, 6), "seconds": round(seconds, 6), "pid": os.getpid()}
+            self.trace.write(json.dumps({**line, **self.labels, **attributes}) + "\n")
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+        """
+        Times the block. Attributes can be added to the yielded dict while it runs, `node` and `result` also label the
+        histogram. A block that raises gets the result `error` unless it set one.
+        """
+        started = time.time()
+        begun = time.monotonic()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes.setdefault("result", "cancelled" if isinstance(e, asyncio.CancelledError) else "error")
+            raise
+        finally:
+            self.record_span(name, started, time.monotonic() - begun, **attributes)
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Measures how long requests take to send and how long the server takes to answer once everything is sent"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params) -> None:
+            context.started = time.monotonic()
+            context.sent = None
+
+        async def on_request_chunk_sent(session, context, params) -> None:
+            context.sent = time.monotonic()
+            self.inc("bytes_sent_total", len(params.chunk), node=str(params.url.origin()))
+
+        async def on_request_end(session, context, params) -> None:
+            now = time.monotonic()
+            node = str(params.url.origin())
+            sent = context.sent or context.started
+            self.observe("request_send_seconds", sent - context.started, node=node)
+            self.observe("server_wait_seconds", now - sent, node=node)
+
+        async def on_request_exception(session, context, params) -> None:
+            self.inc("request_errors_total", node=str(params.url.origin()))
+
+        async def on_connection_create_end(session, context, params) -> None:
+            self.inc("connections_opened_total")
+
+        async def on_connection_reuseconn(session, context, params) -> None:
+            self.inc("connections_reused_total")
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def prometheus(self) -> str:
+        lines = []
+        own = format_labels(label_key(self.labels))
+        for name, read in sorted(self.gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                continue
+            if name in self.help:
+                lines.append(f"# HELP {self.prefix}{name} {self.help[name]}")
+            lines.append(f"# TYPE {self.prefix}{name} gauge")
+            lines.append(f"{self.prefix}{name}{own} {value}")
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}{name} counter")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{self.prefix}{name}{format_labels(labels)} {value}")
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {self.prefix}{name} histogram")
+            for labels, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(list(BUCKETS) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{self.prefix}{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}"
+                    )
+                lines.append(f"{self.prefix}{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{self.prefix}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self) -> None:
+        if not self.metrics_path:
+            return
+        self.metrics_path.parent.mkdir(parents=True, exist_ok=True)
+        # The textfile collector may read at any time so it must never see half a file
+        temporary = self.metrics_path.with_name(f".{self.metrics_path.name}.{os.getpid()}.tmp")
+        temporary.write_text(self.prometheus())
+        os.replace(temporary, self.metrics_path)
+
+    async def start(self, host: str = "127.0.0.1") -> None:
+        if self.metrics_path:
+            self._tasks.append(asyncio.ensure_future(self._write_periodically()))
+        if self.metrics_port is not None:
+            app = web.Application()
+            app.router.add_get("/metrics", self._handle_metrics)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, host, self.metrics_port).start()
+            logger.info(f"Serving metrics on http://{host}:{self.metrics_port}/metrics")
+
+    async def _write_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write_metrics()
+            except OSError as e:
+                logger.warning(f"Unable to write metrics to {self.metrics_path}: {e}")
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.prometheus(), content_type="text/plain", charset="utf-8")
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            self.write_metrics()
+        except OSError as e:
+            logger.warning(f"Unable to write metrics to {self.metrics_path}: {e}")
+        if self.trace:
+            self.trace.close()
+            self.trace = None
@@ -1,4 +1,4 @@
-from typing import List, TypedDict
+from typing import List, Optional, TypedDict
 
 
 class ChunkSize(TypedDict):
@@ -32,6 +32,16 @@ class CheckResponse(TypedDict):
     defaultTemporaryUploadAge: int
 
 
+# Parsed from the CheckResponse
+class ServerLimits(TypedDict):
+    maxFileSize: int
+    chunkSize: int
+    maxChunkSize: int
+    # Milliseconds
+    chunkTimeout: Optional[int]
+    blacklistExtensions: List[str]
+
+
 class NodeResponse(TypedDict):
     success: bool
     url: str
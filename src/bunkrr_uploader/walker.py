@@ -0,0 +1,80 @@
+import asyncio
+import itertools
+import logging
+import os
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def walk_files(path: Path, recursive: bool = False) -> Iterator[Path]:
+    """
+    Lazily yields the files in a directory, and in all of its subdirectories when `recursive`, using os.scandir.
+
+    Only one directory is open at a time, subdirectories are visited once their parent has been listed. Symlinked
+    directories aren't followed so links can't cause loops.
+    """
+    if path.is_file():
+        yield path
+        return
+
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            yield Path(entry.path)
+                        elif recursive and entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(Path(entry.path))
+                    except OSError as e:
+                        logger.error(f"Skipping {entry.path}: {e}")
+        except OSError as e:
+            logger.error(f"Unable to list {directory}: {e}")
+        stack.extend(sorted(subdirectories, reverse=True))
+
+
+def walk_directories(path: Path, recursive: bool = False) -> Iterator[Path]:
+    """Yields the directory and, when `recursive`, all of its subdirectories without following symlinks"""
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        yield directory
+        if not recursive:
+            continue
+        try:
+            with os.scandir(directory) as entries:
+                stack.extend(sorted((Path(x.path) for x in entries if x.is_dir(follow_symlinks=False)), reverse=True))
+        except OSError as e:
+            logger.error(f"Unable to list {directory}: {e}")
+
+
+async def iterate_in_thread(
+    iterator: Iterator[T], transform: Optional[Callable[[T], List[T]]] = None, batch_size: int = 256
+) -> AsyncIterator[T]:
+    """
+    Pulls items from a blocking iterator in a worker thread, `batch_size` at a time, so slow disks don't block the
+    event loop. `transform` also runs in the thread and can replace each item with any number of items.
+    """
+    loop = asyncio.get_running_loop()
+
+    def next_batch() -> Tuple[List[T], bool]:
+        batch = []
+        taken = 0
+        for item in itertools.islice(iterator, batch_size):
+            taken += 1
+            batch.extend(transform(item) if transform else [item])
+        return batch, taken < batch_size
+
+    while True:
+        batch, exhausted = await loop.run_in_executor(None, next_batch)
+        for item in batch:
+            yield item
+        if exhausted:
+            return
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+from .walker import walk_files
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryWatcher:
+    """
+    Looks for new or changed files in a directory every `interval` seconds and hands them to `on_ready` once their size
+    and modification time stayed the same for `settle` seconds, so files that are still being written or copied aren't
+    uploaded half way. Files that are already there when watching starts are handed over too.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        on_ready: Callable[[List[Path]], Awaitable[None]],
+        recursive: bool = False,
+        settle: float = 10,
+        interval: float = 2,
+    ):
+        self.path = path
+        self.on_ready = on_ready
+        self.recursive = recursive
+        self.settle = settle
+        self.interval = interval
+        # Files waiting to settle with the signature they had and since when
+        self.pending: Dict[Path, Tuple[Tuple[int, int], float]] = {}
+        # Signature of every file that was handed over so it only comes back when it changes
+        self.handed_over: Dict[Path, Tuple[int, int]] = {}
+        self._tasks: Set[asyncio.Future] = set()
+
+    def scan(self) -> Dict[Path, Tuple[int, int]]:
+        files = {}
+        for file in walk_files(self.path, self.recursive):
+            try:
+                stat = os.stat(file)
+            except OSError:
+                # Deleted or moved away since it was listed
+                continue
+            files[file] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def ready_files(self, files: Dict[Path, Tuple[int, int]], now: float) -> List[Path]:
+        ready = []
+        for file, signature in files.items():
+            if self.handed_over.get(file) == signature:
+                continue
+            previous = self.pending.get(file)
+            if previous is None or previous[0] != signature:
+                self.pending[file] = (signature, now)
+            elif now - previous[1] >= self.settle:
+                ready.append(file)
+                self.handed_over[file] = signature
+                del self.pending[file]
+        for file in [x for x in self.pending if x not in files]:
+            del self.pending[file]
+        # Files that went away are forgotten so a long running daemon doesn't keep every path it ever saw
+        for file in [x for x in self.handed_over if x not in files]:
+            del self.handed_over[file]
+        return ready
+
+    async def run(self) -> None:
+        logger.info(f"Watching {self.path} for files to upload")
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                files = await loop.run_in_executor(None, self.scan)
+                ready = self.ready_files(files, time.monotonic())
+                if ready:
+                    logger.info(f"{len(ready)} files in {self.path} are ready to upload")
+                    # Uploads run on their own so new files keep being noticed meanwhile
+                    task = asyncio.ensure_future(self.on_ready(ready))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                await asyncio.sleep(self.interval)
+        finally:
+            for task in self._tasks:
+                task.cancel()